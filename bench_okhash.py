@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Benchmark O(K)hash throughput, latency and bytes read across K levels, input sizes and read backends.
+#
+#   python3 bench_okhash.py                 # default matrix
+#   python3 bench_okhash.py --quick         # small inputs only, a few seconds
+#   python3 bench_okhash.py --json out.json # also dump raw results for comparing runs
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+from os.path import join
+
+import okhash
+
+KiB, MiB, GiB = 1024, 1024 * 1024, 1024 * 1024 * 1024
+
+# Sizes straddle the full SHA-256 fallback threshold (2 * base size) of K=1 and K=2, then go into the sampled regime
+QUICK_SIZES = [1 * KiB, 2 * KiB, 2 * KiB + 1, 64 * KiB, 2 * MiB, 2 * MiB + 1, 16 * MiB]
+DEFAULT_SIZES = QUICK_SIZES + [256 * MiB]
+# Sparse fixtures: mostly holes with a few data extents, big enough to sample at K=3
+SPARSE_SIZES = [4 * GiB]
+IN_MEMORY_LIMIT = 256 * MiB
+
+BACKENDS = ['bytes', 'BytesIO', 'file-auto', 'file-pread', 'file-sparse', 'file-buffered']
+
+
+def _generate_file(filepath, size, sparse=False):
+    with open(filepath, 'wb') as fou:
+        if sparse:
+            # a 1 MiB data extent every 256 MiB, the rest left as holes
+            fou.truncate(size)
+            for offset in range(0, size, 256 * MiB):
+                fou.seek(offset)
+                fou.write(os.urandom(min(MiB, size - offset)))
+        else:
+            written = 0
+            while written < size:
+                chunk = min(4 * MiB, size - written)
+                fou.write(os.urandom(chunk))
+                written += chunk
+
+
+def _hash_func(backend, filepath, data, K):  # noqa
+    if backend == 'bytes':
+        return lambda: okhash.okhash(data, K=K)
+    if backend == 'BytesIO':
+        stream = BytesIO(data)
+        return lambda: okhash.okhash(stream, K=K)
+    return lambda: okhash.okhash_filepath(filepath, K=K, backend=backend[len('file-'):])
+
+
+def _bytes_read(filepath, K):  # noqa
+    # counted in a separate, untimed run
+    stats = okhash.HashStats()
+    okhash.okhash_filepath(filepath, K=K, stats=stats)
+    return stats.seeks, stats.bytes_read
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run(sizes, sparse_sizes, k_values, backends, repeat, min_time, bench_dir):
+    results = list()
+    fixtures = [(size, False) for size in sizes] + [(size, True) for size in sparse_sizes]
+
+    for size, sparse in fixtures:
+        filepath = join(bench_dir, f"{'sparse' if sparse else 'file'}_{size}.bin")
+        if not os.path.exists(filepath):
+            _generate_file(filepath, size, sparse=sparse)
+
+        data = None
+        if size <= IN_MEMORY_LIMIT:
+            with open(filepath, 'rb') as fin:
+                data = fin.read()
+
+        for K in k_values:  # noqa
+            seeks, bytes_read = _bytes_read(filepath, K)
+            for backend in backends:
+                if data is None and not backend.startswith('file-'):
+                    continue
+
+                func = _hash_func(backend, filepath, data, K)
+                func()  # warm up, also brings the file into the page cache
+
+                latencies = list()
+                started = time.perf_counter()
+                while len(latencies) < repeat or time.perf_counter() - started < min_time:
+                    t0 = time.perf_counter()
+                    func()
+                    latencies.append(time.perf_counter() - t0)
+                total = sum(latencies)
+
+                results.append({
+                    'size': size,
+                    'sparse': sparse,
+                    'K': K,
+                    'backend': backend,
+                    'runs': len(latencies),
+                    'seeks': seeks,
+                    'bytes_read': bytes_read,
+                    'files_per_s': len(latencies) / total,
+                    'effective_gib_per_s': size * len(latencies) / total / GiB,
+                    'read_gib_per_s': bytes_read * len(latencies) / total / GiB,
+                    'p50_ms': statistics.median(latencies) * 1000,
+                    'p90_ms': _percentile(latencies, 90) * 1000,
+                    'p99_ms': _percentile(latencies, 99) * 1000,
+                })
+                _print_result(results[-1])
+
+    return results
+
+
+def _format_size(size):
+    for unit, factor in (('GiB', GiB), ('MiB', MiB), ('KiB', KiB)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def _print_header():
+    print(f"{'size':>12} {'K':>2} {'backend':>14} {'runs':>6} {'read':>10} {'files/s':>10} "
+          f"{'eff GiB/s':>10} {'read GiB/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+
+
+def _print_result(r):
+    size = _format_size(r['size']) + (' sparse' if r['sparse'] else '')
+    print(f"{size:>12} {r['K']:>2} {r['backend']:>14} {r['runs']:>6} {_format_size(r['bytes_read']):>10} "
+          f"{r['files_per_s']:>10.1f} {r['effective_gib_per_s']:>10.3f} {r['read_gib_per_s']:>10.3f} "
+          f"{r['p50_ms']:>9.3f} {r['p90_ms']:>9.3f} {r['p99_ms']:>9.3f}")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark O(K)hash across K levels, input sizes and backends.")
+    parser.add_argument('--quick', action='store_true', help='small inputs only, no sparse fixtures')
+    parser.add_argument('-K', type=int, nargs='+', default=[1, 2, 3, 4], help='K levels to benchmark')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS, help='input backends')
+    parser.add_argument('--repeat', type=int, default=5, help='minimum number of timed runs per case')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds of timed runs per case')
+    parser.add_argument('--dir', help='directory for the fixture files (default: a temporary directory)')
+    parser.add_argument('--json', metavar='PATH', help='also write the raw results as JSON')
+    args = parser.parse_args()
+
+    bench_dir = args.dir or tempfile.mkdtemp(prefix='okhash_bench_')
+    os.makedirs(bench_dir, exist_ok=True)
+    try:
+        _print_header()
+        results = run(
+            QUICK_SIZES if args.quick else DEFAULT_SIZES,
+            [] if args.quick else SPARSE_SIZES,
+            args.K, args.backends, args.repeat, args.min_time, bench_dir
+        )
+    finally:
+        if not args.dir:
+            shutil.rmtree(bench_dir)
+
+    if args.json:
+        with open(args.json, 'w') as fou:
+            json.dump({'version': okhash.VERSION, 'results': results}, fou, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,63 @@
+import errno
 import hashlib
+import io
 import math
-import re
+import mmap
+import os
+import stat
+import struct
 import sys
-from io import BytesIO
-import argparse
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache, partial
+from itertools import chain, tee
+from os import cpu_count
 from os.path import exists
-from typing import BinaryIO
+
+# Only what okhash() needs is imported at load time: the CLI is often run once per file (shell loops,
+# find -exec), where importing asyncio, sqlite3, concurrent.futures or argparse costs more than hashing
+# a small file. Those are imported by the functions using them.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import argparse
+    from typing import BinaryIO
 
 VERSION = '1.0'
 DEFAULT_K = 2
+# Largest K the daemon accepts, the level 7 base size (2^70 bytes) is past any file size so no digest goes further
+SERVER_MAX_K = 7
 SHA256_DIGEST_LEN = 32
+PROFILE_MAGIC = b'OKHP\x00\x01\x00\x00'
+PROFILE_FINGERPRINT_LEN = 3
+PROFILE_MAX_LEVELS = (SHA256_DIGEST_LEN - len(PROFILE_MAGIC)) // PROFILE_FINGERPRINT_LEN
+# Digest constructors selectable in a HashProfile, all producing SHA256_DIGEST_LEN bytes digests
+DIGEST_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': partial(hashlib.blake2b, digest_size=SHA256_DIGEST_LEN),
+    'blake2s': hashlib.blake2s,
+    'sha3_256': hashlib.sha3_256,
+}
+READ_BACKENDS = ('auto', 'mmap', 'pread', 'sparse', 'buffered')
+BATCH_THREAD_MIN_SIZE = 1024 * 1024
+BINARY_MANIFEST_MAGIC = b'OKHM'
+_MANIFEST_HEADER = struct.Struct('<4sBBHQ')
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+DEFAULT_CACHE_ENTRIES = 1000000
+ASYNC_OFFLOAD_SIZE = 64 * 1024
+ASYNC_FALLBACK_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.5
+METRICS_INTERVAL = 10
+METRICS_FORMATS = ('prometheus', 'json')
+FALLBACK_CHUNK_SIZE = 1024 * 1024
+RANGE_BLOCK_SIZE = 4096
+RANGE_CACHE_BYTES = 16 * 1024 * 1024
+HTTP_TIMEOUT = 30
+HTTP_MAX_IDLE_CONNECTIONS = 8
 status_code = 0
 format_errors, file_errors, checksum_errors = 0, 0, 0
-args: argparse.Namespace | None = None
+args: 'argparse.Namespace | None' = None
 
 
 def _calculate_next_position(m, size):
@@ -43,55 +88,446 @@ def _calculate_next_position(m, size):
     return address % size
 
 
-def _sub_okhash(k, input_stream, input_size, base_size):
-    input_stream.seek(0)
-    if input_size <= base_size * 2:
-        return sha256(input_stream)
-    block_size = 1024 * math.ceil(2 ** (6 * k) / 1024)
-    count = math.ceil(base_size / block_size)
+def _next_position_func(size):
+    # Per-input specialization of _calculate_next_position: the address length depends only on the size,
+    # and a single SHA-256 digest covers every address shorter than 256 bits, so the common case is
+    # one digest, one slice and one modulo per block. Positions are identical to the reference above.
+    address_len = int(math.log2(size)) + 1
+    if address_len > SHA256_DIGEST_LEN * 8:
+        return partial(_calculate_next_position, size=size)
 
-    m = hashlib.sha256()
-    m.update(str(input_size).encode('utf-8'))
+    bytes_needed = (address_len + 7) // 8
+    from_bytes = int.from_bytes
 
-    for _ in range(count):
-        position = _calculate_next_position(m, input_size)
-        input_stream.seek(position)
-        data = input_stream.read(block_size)
-        m.update(data)
+    def _next_position(m):
+        return from_bytes(m.digest()[:bytes_needed], 'big') % size
 
-    return m.digest()
+    return _next_position
+
+
+def _block_size(k):
+    return 1024 * math.ceil(2 ** (6 * k) / 1024)
+
+
+@lru_cache(maxsize=None)
+def _base_sizes(K):  # noqa
+    return tuple(2 ** (10 * k) for k in range(1, K + 1))
+
+
+@lru_cache(maxsize=None)
+def _level_constants(K):  # noqa
+    # (base_size, block_size, block_count) of levels 1..K
+    return tuple((base_size, _block_size(k), math.ceil(base_size / _block_size(k)))
+                 for k, base_size in enumerate(_base_sizes(K), 1))
+
+
+class _MemoryViewReader:
+    # Minimal seek/read/tell file interface returning zero-copy memoryview slices of a buffer
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        data = self.view[self.position:end]
+        self.position += len(data)
+        return data
+
+
+class _PreadReader:
+    # seek/read/tell over a file descriptor, reading with os.preadv into a single reused buffer.
+    # The returned memoryview is only valid until the next read.
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.position = 0
+        self.buffer = bytearray()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self.size - self.position)
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        n = os.preadv(self.fd, [memoryview(self.buffer)[:size]], self.position)
+        self.position += n
+        return memoryview(self.buffer)[:n]
+
+
+class _SparseReader:
+    # seek/read/tell over a file descriptor that skips holes: SEEK_DATA/SEEK_HOLE locate the data
+    # extents, blocks lying entirely in a hole are served from a pre-built zero buffer without any
+    # read, and partially sparse blocks only read their data extents. Like _PreadReader, the returned
+    # memoryview is only valid until the next read.
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.position = 0
+        self.buffer = bytearray()
+        self.zeros = bytes()
+        # data extent [start, end) found by the last lookup from `lookup_from`, nothing but holes in between
+        self.lookup_from, self.extent = 0, (0, 0)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def _extent_at(self, offset):
+        # first data extent ending after offset, (size, size) if there is only a hole left
+        if self.lookup_from <= offset < self.extent[1]:
+            return self.extent
+        try:
+            start = os.lseek(self.fd, offset, os.SEEK_DATA)
+            end = os.lseek(self.fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                # SEEK_DATA/SEEK_HOLE not supported here (EINVAL, EOPNOTSUPP): read everything as data
+                start, end = offset, self.size
+            else:  # no data past offset
+                start = end = self.size
+        self.lookup_from, self.extent = offset, (start, min(end, self.size))
+        return self.extent
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0 or start + size > self.size:
+            size = max(0, self.size - start)
+        end = start + size
+        self.position = end
+
+        if len(self.zeros) < size:
+            self.zeros = bytes(size)
+
+        data_start, data_end = self._extent_at(start)
+        if data_start >= end:
+            return memoryview(self.zeros)[:size]
+
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)[:size]
+        if not (data_start <= start and data_end >= end):
+            view[:] = memoryview(self.zeros)[:size]
+
+        offset = start
+        while offset < end:
+            data_start, data_end = self._extent_at(offset)
+            if data_start >= end:
+                break
+            data_start, data_end = max(data_start, offset), min(data_end, end)
+            os.preadv(self.fd, [view[data_start - start:data_end - start]], data_start)
+            offset = data_end
+        return view
+
+
+class HashStats:
+    # I/O counters of one okhash call, filled in when passed as `stats`. One entry per level in
+    # `levels`, plus a k=0 entry for the first block read shared by the sampled levels. Levels that
+    # reuse an already computed fallback digest are listed with zero counters.
+    def __init__(self):
+        self.levels = list()
+        self.cached = False
+
+    def _add_level(self, k, fallback=False):
+        level = {'k': k, 'fallback': fallback, 'blocks': 0, 'seeks': 0, 'bytes_read': 0, 'seconds': 0.0}
+        self.levels.append(level)
+        return level
+
+    def _total(self, key):
+        return sum(level[key] for level in self.levels)
+
+    @property
+    def blocks(self):
+        return self._total('blocks')
+
+    @property
+    def seeks(self):
+        return self._total('seeks')
+
+    @property
+    def bytes_read(self):
+        return self._total('bytes_read')
+
+    @property
+    def seconds(self):
+        return self._total('seconds')
+
+    @property
+    def fallback(self):
+        return any(level['fallback'] for level in self.levels)
+
+    def as_dict(self):
+        return {
+            'cached': self.cached,
+            'fallback': self.fallback,
+            'blocks': self.blocks,
+            'seeks': self.seeks,
+            'bytes_read': self.bytes_read,
+            'seconds': self.seconds,
+            'levels': [dict(level) for level in self.levels],
+        }
+
+
+class ProfileMismatchError(ValueError):
+    # An okhash compared or verified against one of a different hash profile (or none)
+    pass
+
+
+class HashProfile:
+    # Custom sampling budget: one (base_size, block_size) pair per level, in place of the 2 ** (10 * k)
+    # base sizes and 2 ** (6 * k) block sizes of the standard level k, e.g. to read 64 MiB per file
+    # rather than 1 MiB (K=2) or 1 GiB (K=3). Written as a spec of comma separated base:block levels,
+    # sizes in bytes or with a K, M, G or T (binary) suffix: '1M:1K,64M:64K'.
+    #
+    # The digest algorithm of the sampled levels and the full hash fallback can be changed from SHA-256
+    # to one of DIGEST_ALGORITHMS, or 'blake3' when the blake3 package is installed, prefixing the spec:
+    # 'blake2b@1M:1K,64M:64K'. Positions are still derived from the running digest of each level.
+    #
+    # Digests computed with a profile start with a SHA256_DIGEST_LEN bytes header: PROFILE_MAGIC then,
+    # for each level, a fingerprint of the algorithm and of the canonical spec up to that level. Digests
+    # are only compared over the levels their profiles share, e.g. blake2b checksums of K=3 and K=2,
+    # never with digests of another profile or of the standard levels.
+    def __init__(self, levels, algorithm='sha256'):
+        self.algorithm = algorithm
+        self.new_hash = _digest_constructor(algorithm)
+        levels = tuple((int(base_size), int(block_size)) for base_size, block_size in levels)
+        if not 1 <= len(levels) <= PROFILE_MAX_LEVELS:
+            raise ValueError(f"a hash profile needs between 1 and {PROFILE_MAX_LEVELS} levels")
+        for ix, (base_size, block_size) in enumerate(levels):
+            if not 1 <= block_size <= base_size:
+                raise ValueError("block sizes must be between 1 and the base size of their level")
+            if ix and base_size <= levels[ix - 1][0]:
+                raise ValueError("base sizes must increase from one level to the next")
+
+        self.levels = tuple((base_size, block_size, math.ceil(base_size / block_size))
+                            for base_size, block_size in levels)
+        level_specs = [f"{_format_size_spec(base_size)}:{_format_size_spec(block_size)}"
+                       for base_size, block_size in levels]
+        self.spec = ','.join(level_specs)
+        if algorithm != 'sha256':
+            self.spec = f"{algorithm}@{self.spec}"
+        fingerprints = b''.join(
+            hashlib.sha256(f"{algorithm}@{','.join(level_specs[:ix + 1])}".encode('utf-8')).digest()[
+                :PROFILE_FINGERPRINT_LEN]
+            for ix in range(len(level_specs)))
+        self.header = (PROFILE_MAGIC + fingerprints).ljust(SHA256_DIGEST_LEN, b'\x00')
+
+    @classmethod
+    def parse(cls, spec):
+        algorithm, _, spec = spec.rpartition('@')
+        levels = list()
+        for level in spec.split(','):
+            base_size, _, block_size = level.partition(':')
+            levels.append((_parse_size_spec(base_size), _parse_size_spec(block_size)))
+        return cls(levels, algorithm.strip().lower() or 'sha256')
+
+    @classmethod
+    def standard(
+            cls,
+            K,  # noqa
+            algorithm='sha256'
+    ):
+        # the K standard levels, e.g. to only change the digest algorithm
+        if K < 1:
+            raise ValueError("K must be at least 1")
+        return cls(((base_size, block_size) for base_size, block_size, _ in _level_constants(K)), algorithm)
+
+    def __repr__(self):
+        return f"HashProfile.parse({self.spec!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, HashProfile) and self.spec == other.spec
+
+    def __hash__(self):
+        return hash(self.spec)
+
+
+def _digest_constructor(algorithm):
+    if algorithm in DIGEST_ALGORITHMS:
+        return DIGEST_ALGORITHMS[algorithm]
+    if algorithm == 'blake3':
+        try:
+            from blake3 import blake3
+        except ImportError:
+            raise ValueError("the blake3 digest algorithm requires the blake3 package") from None
+        return blake3
+    raise ValueError(f"digest algorithm must be one of {', '.join([*DIGEST_ALGORITHMS, 'blake3'])}")
+
+
+_SIZE_SUFFIXES = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def _parse_size_spec(spec):
+    size = spec.strip().upper().removesuffix('IB').removesuffix('B')
+    number, suffix = (size[:-1], size[-1]) if size[-1:].isalpha() else (size, '')
+    if not number.isdigit() or suffix not in _SIZE_SUFFIXES:
+        raise ValueError(f"invalid size in hash profile: {spec!r}")
+    return int(number) * _SIZE_SUFFIXES[suffix]
+
+
+def _format_size_spec(size):
+    for suffix in ('T', 'G', 'M', 'K'):
+        if size % _SIZE_SUFFIXES[suffix] == 0:
+            return f"{size // _SIZE_SUFFIXES[suffix]}{suffix}"
+    return str(size)
+
+
+def _profile_parts(profile):
+    # (levels, digest header, digest constructor) of a HashProfile, the standard ones for None
+    if profile is None:
+        return None, b'', hashlib.sha256
+    return profile.levels, profile.header, profile.new_hash
+
+
+def _split_profile(digest):
+    # (profile header or None, level digests) of an okhash
+    if digest[:len(PROFILE_MAGIC)] == PROFILE_MAGIC and len(digest) >= SHA256_DIGEST_LEN:
+        return bytes(digest[:SHA256_DIGEST_LEN]), digest[SHA256_DIGEST_LEN:]
+    return None, digest
+
+
+def _compatible_headers(
+        header1,
+        header2,
+        K  # noqa
+):
+    # whether digests with these profile headers (None for the standard levels) share their first K levels
+    if header1 is None or header2 is None:
+        return header1 is header2
+    end = len(PROFILE_MAGIC) + max(K, 1) * PROFILE_FINGERPRINT_LEN
+    return header1[:end] == header2[:end]
 
 
 def okhash(
-        input_stream: BinaryIO | str | bytes,
+        input_stream: 'BinaryIO | str | bytes | bytearray | memoryview | mmap.mmap',
         input_size=None,
-        K=DEFAULT_K  # noqa
+        K=DEFAULT_K,  # noqa
+        stats=None,
+        profile=None
 ):
-    if K < 1:
-        raise ValueError("K must be at least 1")
+    # With a HashProfile, its levels are computed instead of the K standard ones
+    levels, header, new_hash = _profile_parts(profile)
+    if stats is None and (K >= 1 or levels) and isinstance(input_stream, (bytes, bytearray, memoryview, mmap.mmap)):
+        return header + _okhash_buffer(memoryview(input_stream).cast('B'), K, levels, new_hash)
+    return header + b''.join(_okhash_levels(input_stream, input_size, K, stats=stats, levels=levels,
+                                            new_hash=new_hash))
+
+
+def _okhash_buffer(
+        view,
+        K,  # noqa
+        levels=None,
+        new_hash=hashlib.sha256
+):
+    # In-memory fast path of _okhash_levels: blocks are hashed straight from memoryview slices,
+    # without a reader object or seeks, and the full hash fallback is a single update.
+    digests, K = _run_requests(_okhash_requests(len(view), K, levels, new_hash),  # noqa
+                               lambda offset, length: view[offset:offset + length])
+    if len(digests) < K:
+        digests.extend([new_hash(view).digest()] * (K - len(digests)))
+    return b''.join(digests)
+
+
+def _okhash_levels(
+        input_stream,
+        input_size,
+        K,  # noqa
+        share_first_block=True,
+        stats=None,
+        levels=None,
+        new_hash=hashlib.sha256
+):
+    # Yield the digest of each level in order, so callers can stop after the first mismatching one.
+    # levels: (base_size, block_size, block_count) of each level, the K standard ones when None,
+    # hashed with new_hash.
+    input_stream, input_size = _normalize_input(input_stream, input_size)
+    K, sampled_levels = _sampled_levels(input_size, K, levels)
+
+    # Levels are sampled up to some k, then fall back to the same full-stream hash for every
+    # remaining level: compute that fallback once, and share the first block across sampled levels.
+    first_block = None
+    if share_first_block and len(sampled_levels) > 1:
+        level_stats, started = None, None
+        if stats is not None:
+            level_stats, started = stats._add_level(0), time.perf_counter()
+        # copy: zero-copy readers may hand out views of a buffer they reuse on the next read
+        first_block = bytes(_read_stream_at(input_stream, level_stats,
+                                            *_first_block_request(input_size, sampled_levels, new_hash)))
+        if stats is not None:
+            level_stats['seconds'] = time.perf_counter() - started
+
+    for k, (_, block_size, count) in enumerate(sampled_levels, 1):
+        level_stats, started = None, None
+        if stats is not None:
+            level_stats, started = stats._add_level(k), time.perf_counter()
+        digest = _run_requests(_level_requests(input_size, block_size, count, first_block, new_hash),
+                               partial(_read_stream_at, input_stream, level_stats))
+        if stats is not None:
+            level_stats.update(blocks=count, seconds=time.perf_counter() - started)
+        yield digest
+
+    if len(sampled_levels) < K:
+        level_stats, started = None, None
+        if stats is not None:
+            level_stats, started = stats._add_level(len(sampled_levels) + 1, fallback=True), time.perf_counter()
+        input_stream.seek(0)
+        fallback_digest = sha256(input_stream, new_hash=new_hash)
+        if stats is not None:
+            level_stats.update(seeks=1, bytes_read=input_size, seconds=time.perf_counter() - started)
+        yield fallback_digest
 
+        for k in range(len(sampled_levels) + 2, K + 1):
+            if stats is not None:
+                stats._add_level(k, fallback=True)
+            yield fallback_digest
+
+
+def _normalize_input(input_stream, input_size):
     if input_stream is None:
         raise ValueError("Input stream cannot be None")
 
-    if isinstance(input_stream, (str, bytes)):
+    if isinstance(input_stream, (str, bytes, bytearray, memoryview, mmap.mmap)):
         if isinstance(input_stream, str):
             input_stream = bytes(input_stream, encoding='utf-8')
-        input_size = len(input_stream)
-        input_stream = BytesIO(input_stream)
+        input_stream = _MemoryViewReader(input_stream)
+        input_size = len(input_stream.view)
 
     elif not (hasattr(input_stream, 'read') and hasattr(input_stream, 'seek') and hasattr(input_stream, 'tell')):
-        raise ValueError("Input stream must be a bytes-like file object, str, or bytes")
+        raise ValueError("Input stream must be a bytes-like file object, a buffer, or str")
 
     if input_size is None:
         input_stream.seek(0, 2)
         input_size = input_stream.tell()
         input_stream.seek(0)
 
-    # downgrade K
-    base_sizes = [2 ** (10 * k) for k in range(1, K + 1)]
-    K = _downgrade_k(input_size, K, base_sizes)
-
-    return b''.join(_sub_okhash(k, input_stream, input_size, base_sizes[k - 1]) for k in range(1, K + 1))
+    return input_stream, input_size
 
 
 def _downgrade_k(
@@ -107,17 +543,1279 @@ def _downgrade_k(
 
 def okhash_filepath(  # noqa
         filepath,
-        K=DEFAULT_K  # noqa
+        K=DEFAULT_K,  # noqa
+        backend='auto',
+        cache=None,
+        stats=None,
+        profile=None
+):
+    # backend 'auto' hashes regular files through 'pread', or 'sparse' for files with holes. 'pread'
+    # reads with os.preadv into one reused buffer (double-buffered by a reader thread for full reads),
+    # 'sparse' skips holes with SEEK_DATA/SEEK_HOLE, 'mmap' hands out zero-copy memoryview slices of
+    # the mapped file (but a file truncated while mapped kills the process with SIGBUS), 'buffered'
+    # uses the plain file object.
+    if backend not in READ_BACKENDS:
+        raise ValueError(f"backend must be one of {', '.join(READ_BACKENDS)}")
+
+    if profile is not None:
+        # cached digests are keyed by K only
+        if cache is not None:
+            raise ValueError("a cache cannot be used with a hash profile")
+        with open(filepath, 'rb') as fin:
+            return _okhash_file(fin, os.fstat(fin.fileno()), backend, partial(okhash, stats=stats, profile=profile))
+
+    if cache is None:
+        with open(filepath, 'rb') as fin:
+            return _okhash_file(fin, os.fstat(fin.fileno()), backend, partial(okhash, K=K, stats=stats), K)
+
+    st = os.stat(filepath)
+    digest = cache.get(st, K)
+    if digest is not None and stats is not None:
+        stats.cached = True
+    if digest is None:
+        with open(filepath, 'rb') as fin:
+            digest = _okhash_file(fin, os.fstat(fin.fileno()), backend, partial(okhash, K=K, stats=stats), K)
+            # only trust the digest if the file did not change while it was being hashed
+            if _cache_key(os.fstat(fin.fileno())) == _cache_key(st):
+                cache.put(st, K, digest)
+    return digest
+
+
+def verify_okhash_filepath(
+        filepath,
+        expected_hash,
+        K=None,  # noqa
+        early_exit=True,
+        backend='auto',
+        cache=None,
+        stats=None,
+        profile=None
+):
+    # Check a file against a stored okhash, computing only the levels the comparison can use:
+    # K defaults to the number of levels in expected_hash. With early_exit, hashing stops at the
+    # first mismatching level (ignored when a cache is given, since only complete digests are stored).
+    # expected_hash must have been computed with a hash profile sharing the levels that are checked,
+    # ValueError is raised otherwise.
+    header, expected_hash = _split_profile(expected_hash)
+    expected_k = len(expected_hash) // SHA256_DIGEST_LEN
+    K = expected_k if K is None else min(K, expected_k)
+    if profile is not None:
+        K = min(K, len(profile.levels))
+    if not _compatible_headers(header, None if profile is None else profile.header, K):
+        raise ProfileMismatchError("the expected hash was computed with a different hash profile")
+
+    if K < 1:
+        return False
+    levels = None if profile is None else profile.levels[:K]
+
+    if not early_exit or cache is not None:
+        digest = okhash_filepath(filepath, K=K, backend=backend, cache=cache, stats=stats, profile=profile)
+        return compare_okhashes(expected_hash[:K * SHA256_DIGEST_LEN], _split_profile(digest)[1])
+
+    if backend not in READ_BACKENDS:
+        raise ValueError(f"backend must be one of {', '.join(READ_BACKENDS)}")
+
+    def _verify(input_stream, input_size):
+        digests = _okhash_levels(input_stream, input_size, K, share_first_block=False, stats=stats, levels=levels,
+                                 new_hash=hashlib.sha256 if profile is None else profile.new_hash)
+        for ix, digest in enumerate(digests):
+            if digest != expected_hash[ix * SHA256_DIGEST_LEN:(ix + 1) * SHA256_DIGEST_LEN]:
+                digests.close()
+                return False
+        return True
+
+    with open(filepath, 'rb') as fin:
+        return _okhash_file(fin, os.fstat(fin.fileno()), backend, _verify, K if profile is None else None)
+
+
+def _okhash_file(fin, st, backend, digest_func, K=None):  # noqa
+    # Run digest_func(input_stream, input_size) over the opened file through the selected read backend.
+    # K is the number of levels digest_func computes, 0 for a plain SHA-256, or None if unknown.
+    full_read = K == 0 or (K is not None and st.st_size <= 2 * 2 ** (10 * K))
+    if backend == 'auto':
+        # special files may not support positioned reads; files with fewer allocated blocks than their
+        # size have holes worth skipping. Not mmap: a file truncated while mapped raises SIGBUS on access.
+        if not stat.S_ISREG(st.st_mode):
+            backend = 'buffered'
+        elif hasattr(os, 'SEEK_DATA') and getattr(st, 'st_blocks', st.st_size) * 512 < st.st_size:
+            backend = 'sparse'
+        else:
+            backend = 'pread'
+
+    # empty files cannot be mapped and have nothing to read anyway
+    if backend == 'buffered' or st.st_size == 0 or (backend in ('pread', 'sparse') and not hasattr(os, 'preadv')):
+        return digest_func(fin, None)
+
+    if backend == 'pread':
+        return digest_func(_PreadReader(fin.fileno(), st.st_size), st.st_size)
+
+    if backend == 'sparse' and hasattr(os, 'SEEK_DATA'):
+        return digest_func(_SparseReader(fin.fileno(), st.st_size), st.st_size)
+
+    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if full_read and hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return digest_func(mm, None)
+
+
+async def okhash_async(
+        reader,
+        input_size,
+        K=DEFAULT_K,  # noqa
+        executor=None,
+        profile=None
+):
+    # Same digest as okhash(), over any object with an `async read_at(offset, n)` method, e.g. a
+    # range-readable remote blob. Hashing blocks of ASYNC_OFFLOAD_SIZE bytes or more runs in
+    # `executor` (the loop's default when None) so the event loop is never blocked for long.
+    if K < 1 and profile is None:
+        raise ValueError("K must be at least 1")
+
+    if not hasattr(reader, 'read_at'):
+        raise ValueError("Reader must provide an async read_at(offset, n) method")
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    levels, header, new_hash = _profile_parts(profile)
+
+    requests = _okhash_requests(input_size, K, levels, new_hash)
+    request, result = _advance(requests)
+    while request is not None:
+        data = await reader.read_at(*request)
+        if len(data) >= ASYNC_OFFLOAD_SIZE:
+            request, result = await loop.run_in_executor(executor, _advance, requests, data)
+        else:
+            request, result = _advance(requests, data)
+    digests, K = result  # noqa
+
+    if len(digests) < K:
+        m = new_hash()
+        for offset in range(0, input_size, ASYNC_FALLBACK_CHUNK_SIZE):
+            data = await reader.read_at(offset, min(ASYNC_FALLBACK_CHUNK_SIZE, input_size - offset))
+            if len(data) >= ASYNC_OFFLOAD_SIZE:
+                await loop.run_in_executor(executor, m.update, data)
+            else:
+                m.update(data)
+        digests.extend([m.digest()] * (K - len(digests)))
+
+    return header + b''.join(digests)
+
+
+class OKHasher:
+    # Incremental okhash of a file or seekable stream that only grows (logs, downloads in progress).
+    # update_size() is a cheap "did it change?" check, digest() recomputes only after a change:
+    # the full SHA-256 fallback is extended with the appended bytes instead of being redone. Sampled
+    # levels are read again, since the size mixed into the chain moves every position on an append.
+    # Bytes before the previous size are assumed unchanged; a shrinking input resets all the state.
+    def __init__(
+            self,
+            source,
+            K=DEFAULT_K,  # noqa
+            profile=None
+    ):
+        if K < 1 and profile is None:
+            raise ValueError("K must be at least 1")
+
+        self.K = K
+        self._levels, self._header, self._new_hash = _profile_parts(profile)
+        self.bytes_read = 0
+        self._owns_stream = isinstance(source, (str, bytes, os.PathLike))
+        self._stream = open(source, 'rb') if self._owns_stream else source
+        self._sha256, self._sha256_size = self._new_hash(), 0
+        self._digest = None
+        self.size = None
+        self.update_size()
+
+    def update_size(self, size=None):
+        # Refresh the input size (or set it, when known from elsewhere), returns True if it changed
+        if size is None:
+            try:
+                size = os.fstat(self._stream.fileno()).st_size
+            except (AttributeError, OSError):  # io.UnsupportedOperation: in-memory streams such as BytesIO
+                size = self._stream.seek(0, 2)
+
+        if size == self.size:
+            return False
+
+        if self.size is not None and size < self.size:
+            self._sha256, self._sha256_size = self._new_hash(), 0
+        self.size, self._digest = size, None
+        return True
+
+    def digest(self):
+        if self._digest is not None:
+            return self._digest
+
+        digests, K = _run_requests(_okhash_requests(self.size, self.K, self._levels, self._new_hash),  # noqa
+                                   self._read_at)
+        if len(digests) < K:
+            digests.extend([self._full_sha256()] * (K - len(digests)))
+
+        self._digest = self._header + b''.join(digests)
+        return self._digest
+
+    def _full_sha256(self):
+        self._stream.seek(self._sha256_size)
+        while self._sha256_size < self.size:
+            data = self._stream.read(min(1024 * 1024, self.size - self._sha256_size))
+            if not data:
+                break
+            self._sha256.update(data)
+            self._sha256_size += len(data)
+            self.bytes_read += len(data)
+        return self._sha256.copy().digest()
+
+    def _read_at(self, offset, length):
+        # reads of the sampled levels, counted and cut at the known size
+        self._stream.seek(offset)
+        data = self._stream.read(max(0, min(length, self.size - offset)))
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        if self._owns_stream:
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def okhash_stream(
+        stream,
+        K=DEFAULT_K,  # noqa
+        spool_dir=None,
+        stats=None,
+        profile=None
+):
+    # Hash a possibly non-seekable stream (pipe, socket, stdin). Sampled positions depend on the
+    # digest of the previous block, so random access is required: non-seekable input is spooled
+    # to a temporary file (kept in memory up to SPOOL_MAX_MEMORY) instead of being buffered whole.
+    if hasattr(stream, 'seekable') and stream.seekable():
+        return okhash(stream, K=K, stats=stats, profile=profile)
+
+    import shutil
+    import tempfile
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, dir=spool_dir) as spool:
+        shutil.copyfileobj(stream, spool, 1024 * 1024)
+        return okhash(spool, K=K, stats=stats, profile=profile)
+
+
+def okhash_many(
+        filepaths,
+        K=DEFAULT_K,  # noqa
+        workers=None,
+        processes=False,
+        return_exceptions=False,
+        cache=None,
+        on_stats=None,
+        profile=None
+):
+    # Hash many files on a thread (or process) pool, yielding digests in input order.
+    # Sampled reads are latency-bound, so threads scale well past the number of cores.
+    # on_stats(filepath, HashStats) is called from the worker thread after each file.
+    if processes and (cache is not None or on_stats is not None):
+        raise ValueError("a cache or on_stats callback cannot be shared with a process pool")
+
+    return _map_ordered(partial(_hash_entry, K=K, cache=cache, on_stats=on_stats, profile=profile),
+                        filepaths, workers, processes, return_exceptions)
+
+
+def _hash_entry(
+        filepath,
+        K,  # noqa
+        cache,
+        on_stats,
+        profile=None
+):
+    if on_stats is None:
+        return okhash_filepath(filepath, K=K, cache=cache, profile=profile)
+
+    stats = HashStats()
+    digest = okhash_filepath(filepath, K=K, cache=cache, stats=stats, profile=profile)
+    on_stats(filepath, stats)
+    return digest
+
+
+def okhash_scheduled(
+        filepaths,
+        K=DEFAULT_K,  # noqa
+        batch_size=64,
+        return_exceptions=False,
+        profile=None
+):
+    # Hash files in batches, interleaving their block chains to cut seek time on rotational or
+    # tape-backed storage. A chain is sequential within a file (each position depends on the digest
+    # so far), but the chains of different files are independent: at every step, the next read of
+    # each file in the batch is announced with posix_fadvise(WILLNEED) and then issued in
+    # (device, inode) order, inode numbers standing in for the physical placement of the files.
+    # Files (and levels) hashed whole by the full SHA-256 fallback are read sequentially afterwards,
+    # one file at a time in the same order. Digests are yielded in input order.
+    if K < 1 and profile is None:
+        raise ValueError("K must be at least 1")
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+
+    filepaths = iter(filepaths)
+    while True:
+        batch = [filepath for _, filepath in zip(range(batch_size), filepaths)]
+        if not batch:
+            return
+        yield from _okhash_scheduled_batch(batch, K, return_exceptions, profile)
+
+
+def _okhash_scheduled_batch(
+        batch,
+        K,  # noqa
+        return_exceptions,
+        profile=None
 ):
+    levels, header, new_hash = _profile_parts(profile)
+    results = [None] * len(batch)
+    # ix -> [fd, sort key, request generator, pending (offset, length) request]
+    active = dict()
+    # ix -> (fd, sort key, sampled level digests, K) of files still needing their full hash fallback
+    fallback = dict()
+
+    def _finish(_ix, _result):
+        if _ix in active:
+            os.close(active.pop(_ix)[0])
+        if _ix in fallback:
+            os.close(fallback.pop(_ix)[0])
+        if isinstance(_result, Exception) and not return_exceptions:
+            for _fd in chain((state[0] for state in active.values()), (state[0] for state in fallback.values())):
+                os.close(_fd)
+            active.clear()
+            fallback.clear()
+            raise _result
+        results[_ix] = _result
+
+    def _sampled(_ix, _result):
+        _digests, _K = _result  # noqa
+        if len(_digests) < _K:
+            _fd, _key, _, _ = active.pop(_ix)
+            fallback[_ix] = (_fd, _key, _digests, _K)
+        else:
+            _finish(_ix, header + b''.join(_digests))
+
+    for ix, filepath in enumerate(batch):
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+        except OSError as e:
+            _finish(ix, e)
+            continue
+        st = os.fstat(fd)
+        requests = _okhash_requests(st.st_size, K, levels, new_hash)
+        active[ix] = [fd, (st.st_dev, st.st_ino), requests, None]
+        active[ix][3], result = _advance(requests)
+        if result is not None:
+            _sampled(ix, result)
+
+    # Only the sampled chains are interleaved, each file having a single pending read at a time
+    while active:
+        pending = sorted(active.items(), key=lambda item: item[1][1])
+        if hasattr(os, 'posix_fadvise'):
+            for _, (fd, _, _, (offset, length)) in pending:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+        for ix, state in pending:
+            fd, _, requests, (offset, length) = state
+            try:
+                state[3], result = _advance(requests, os.pread(fd, length, offset))
+            except OSError as e:
+                _finish(ix, e)
+                continue
+            if result is not None:
+                _sampled(ix, result)
+
+    # Full hash fallbacks read each file through, one at a time: interleaving them would only add a
+    # seek between every chunk
+    for ix, (fd, _, digests, K) in sorted(fallback.items(), key=lambda item: item[1][1]):  # noqa
+        try:
+            digest = _sha256_fd(fd, 0, os.fstat(fd).st_size, new_hash=new_hash)
+        except OSError as e:
+            _finish(ix, e)
+            continue
+        _finish(ix, header + b''.join(digests + [digest] * (K - len(digests))))
+
+    return results
+
+
+def _sampled_levels(
+        input_size,
+        K,  # noqa
+        levels=None
+):
+    # (K after the downgrade, (base_size, block_size, block_count) of the levels sampled rather than
+    # taking the full hash of the input). levels as in _okhash_levels.
+    if levels is None:
+        if K < 1:
+            raise ValueError("K must be at least 1")
+        levels = _level_constants(K)
+    K = _downgrade_k(input_size, len(levels), tuple(base_size for base_size, _, _ in levels))
+    return K, [level for level in levels[:K] if input_size > level[0] * 2]
+
+
+def _first_block_request(input_size, sampled_levels, new_hash=hashlib.sha256):
+    # The chain state before the first block only holds the input size, so every level starts
+    # reading at the same position and the shorter first blocks are prefixes of the longest one:
+    # the (offset, length) read of the first block shared by all sampled levels.
+    m = new_hash()
+    m.update(str(input_size).encode('utf-8'))
+    return _next_position_func(input_size)(m), max(block_size for _, block_size, _ in sampled_levels)
+
+
+def _level_requests(input_size, block_size, count, first_block=None, new_hash=hashlib.sha256):
+    # Sans-I/O digest of one sampled level, yielding its (offset, length) reads like _okhash_requests.
+    # The read of its first block is skipped when given the shared one.
+    m = new_hash()
+    m.update(str(input_size).encode('utf-8'))
+    next_position = _next_position_func(input_size)
+    for i in range(count):
+        if i == 0 and first_block is not None:
+            m.update(first_block[:block_size])
+        else:
+            m.update((yield next_position(m), block_size))
+    return m.digest()
+
+
+def _okhash_requests(
+        input_size,
+        K,  # noqa
+        levels=None,
+        new_hash=hashlib.sha256
+):
+    # Sans-I/O okhash of the sampled levels, shared by the stream, buffer, async, scheduled and
+    # incremental paths: a generator yielding the (offset, length) reads it needs one at a time, to be
+    # sent the data read, and returning (digests of the sampled levels, K after the downgrade). The
+    # levels past the sampled ones all take the full hash of the input, left to the caller to compute
+    # with whatever suits its I/O. levels and new_hash as in _okhash_levels.
+    K, sampled_levels = _sampled_levels(input_size, K, levels)
+
+    first_block = None
+    if len(sampled_levels) > 1:
+        # copy: readers may hand out views of a buffer they reuse on the next read
+        first_block = bytes((yield _first_block_request(input_size, sampled_levels, new_hash)))
+
+    digests = list()
+    for _, block_size, count in sampled_levels:
+        digests.append((yield from _level_requests(input_size, block_size, count, first_block, new_hash)))
+
+    return digests, K
+
+
+def _read_stream_at(input_stream, level_stats, offset, length):
+    # read_at of _run_requests over a seekable stream, counting its reads in level_stats when given
+    input_stream.seek(offset)
+    data = input_stream.read(length)
+    if level_stats is not None:
+        level_stats['seeks'] += 1
+        level_stats['bytes_read'] += len(data)
+    return data
+
+
+def _advance(requests, data=None):
+    # (next read, None) of an _okhash_requests generator sent data, or (None, its result) once done
+    try:
+        return requests.send(data), None
+    except StopIteration as e:
+        return None, e.value
+
+
+def _run_requests(requests, read_at):
+    # Result of an _okhash_requests generator, its reads served by read_at(offset, length)
+    request, result = _advance(requests)
+    while request is not None:
+        request, result = _advance(requests, read_at(*request))
+    return result
+
+
+def okhash_batch(
+        buffers,
+        K=DEFAULT_K,  # noqa
+        workers=None,
+        profile=None
+):
+    # Hash many in-memory buffers (bytes, bytearray, memoryview, mmap, str), returning digests in order.
+    # Buffers of BATCH_THREAD_MIN_SIZE bytes or more are hashed on a thread pool (hashlib releases the
+    # GIL over large updates) while the small ones are hashed inline, where threads would only add overhead.
+    if K < 1 and profile is None:
+        raise ValueError("K must be at least 1")
+    digest_func = partial(okhash, K=K, profile=profile)
+
+    views = [memoryview(bytes(buffer, encoding='utf-8') if isinstance(buffer, str) else buffer).cast('B')
+             for buffer in buffers]
+    large = [ix for ix, view in enumerate(views) if len(view) >= BATCH_THREAD_MIN_SIZE]
+    if workers == 1 or len(large) < 2:
+        return [digest_func(view) for view in views]
+
+    from concurrent.futures import ThreadPoolExecutor
+    digests = [None] * len(views)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {ix: executor.submit(digest_func, views[ix]) for ix in large}
+        for ix, view in enumerate(views):
+            if ix not in futures:
+                digests[ix] = digest_func(view)
+        for ix, future in futures.items():
+            digests[ix] = future.result()
+
+    return digests
+
+
+def verify_okhashes(
+        entries,
+        K=None,  # noqa
+        workers=None,
+        processes=False,
+        return_exceptions=False,
+        early_exit=True,
+        cache=None,
+        on_stats=None,
+        profile=None
+):
+    # Verify (filepath, expected_hash) entries on a pool, yielding True/False in input order
+    if processes and (cache is not None or on_stats is not None):
+        raise ValueError("a cache or on_stats callback cannot be shared with a process pool")
+
+    return _map_ordered(partial(_verify_entry, K=K, early_exit=early_exit, cache=cache, on_stats=on_stats,
+                                profile=profile),
+                        entries, workers, processes, return_exceptions)
+
+
+def _verify_entry(
+        entry,
+        K,  # noqa
+        early_exit,
+        cache,
+        on_stats,
+        profile=None
+):
+    filepath, expected_hash = entry
+    if on_stats is None:
+        return verify_okhash_filepath(filepath, expected_hash, K=K, early_exit=early_exit, cache=cache,
+                                      profile=profile)
+
+    stats = HashStats()
+    result = verify_okhash_filepath(filepath, expected_hash, K=K, early_exit=early_exit, cache=cache, stats=stats,
+                                    profile=profile)
+    on_stats(filepath, stats)
+    return result
+
+
+def _map_ordered(func, items, workers, processes, return_exceptions):
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    if workers == 1:
+        return _map_sequential(func, items, return_exceptions)
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    workers = workers or min(32, (cpu_count() or 1) + 4)
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    return _map_pool(func, items, workers, executor_class, return_exceptions)
+
+
+def _map_sequential(func, items, return_exceptions):
+    for item in items:
+        try:
+            yield func(item)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            yield e
+
+
+def _map_pool(func, items, workers, executor_class, return_exceptions):
+    with executor_class(max_workers=workers) as executor:
+        # Bound the number of in-flight futures so huge item lists don't pile up in memory
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 4:
+                yield _future_result(pending.popleft(), return_exceptions)
+
+        while pending:
+            yield _future_result(pending.popleft(), return_exceptions)
+
+
+def _future_result(future, return_exceptions):
+    try:
+        return future.result()
+    except Exception as e:
+        if not return_exceptions:
+            raise
+        return e
+
+
+def find_duplicates(
+        paths,
+        K=DEFAULT_K,  # noqa
+        full_hash=False,
+        workers=None,
+        follow_symlinks=False,
+        one_filesystem=False,
+        onerror=None
+):
+    # Yield groups (lists) of duplicate files found under the given files and directories.
+    # Files are grouped by size first, and only size collisions are hashed, one level at a time:
+    # since okhashes are downgradable, level k only has to be computed for files whose levels
+    # 1..k-1 all collided. A level that fell back to a full SHA-256 settles its group for good;
+    # otherwise, with full_hash, groups still colliding after level K are confirmed with a full SHA-256.
+    # onerror(OSError) is called for the entries that cannot be walked or hashed, which are skipped.
+    if K < 1:
+        raise ValueError("K must be at least 1")
+
+    sizes = defaultdict(list)
+    for filepath, st in walk_files(paths, follow_symlinks, one_filesystem, onerror):
+        sizes[st.st_size].append(filepath)
+
+    base_sizes = _base_sizes(K)
+    # (size, level, files): level is the next level to compute, None once the group is settled
+    groups = [(size, 1, files) for size, files in sizes.items() if len(files) > 1]
+
+    while groups:
+        pending, settled = list(), list()
+        for size, level, files in groups:
+            (pending if level is not None else settled).append((size, level, files))
+
+        for size, level, files in settled:
+            yield files
+        if not pending:
+            break
+
+        tasks = [(filepath, level) for size, level, files in pending for filepath in files]
+        digests = _map_ordered(_level_digest_filepath, tasks, workers, False, True)
+
+        groups = list()
+        for size, level, files in pending:
+            by_digest = defaultdict(list)
+            for filepath in files:
+                digest = next(digests)
+                if isinstance(digest, OSError):
+                    if onerror is not None:
+                        onerror(digest)
+                elif isinstance(digest, Exception):
+                    raise digest
+                else:
+                    by_digest[digest].append(filepath)
+
+            if level == 0 or size <= base_sizes[level - 1] * 2:
+                # full SHA-256 of the file, nothing left to escalate to
+                next_level = None
+            elif level < K:
+                next_level = level + 1
+            else:
+                next_level = 0 if full_hash else None
+            groups.extend((size, next_level, same) for same in by_digest.values() if len(same) > 1)
+
+
+def walk_files(
+        paths,
+        follow_symlinks=False,
+        one_filesystem=False,
+        onerror=None
+):
+    # Yield (filepath, stat) for the regular files among paths and under the directories among them,
+    # in sorted depth-first order. Built on os.scandir, so each file costs at most one stat call,
+    # and lazy, so hashing can start before the walk is over. onerror(OSError) is called for
+    # unreadable entries, which are skipped.
+    for path in paths:
+        try:
+            st = os.stat(path) if follow_symlinks else os.lstat(path)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        if not stat.S_ISDIR(st.st_mode):
+            if stat.S_ISREG(st.st_mode):
+                yield path, st
+            continue
+
+        # only needed when following symlinks, which can form directory cycles
+        visited = {(st.st_dev, st.st_ino)}
+        stack = [_scandir_sorted(path, onerror)]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    entry_st = entry.stat(follow_symlinks=follow_symlinks)
+                    if one_filesystem and entry_st.st_dev != st.st_dev:
+                        continue
+                    if follow_symlinks:
+                        if (entry_st.st_dev, entry_st.st_ino) in visited:
+                            continue
+                        visited.add((entry_st.st_dev, entry_st.st_ino))
+                    stack.append(_scandir_sorted(entry.path, onerror))
+                    continue
+
+                if not entry.is_file(follow_symlinks=follow_symlinks):
+                    continue
+                entry_st = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+
+            yield entry.path, entry_st
+
+
+def okhash_tree(
+        path,
+        K=DEFAULT_K,  # noqa
+        workers=None,
+        cache=None,
+        follow_symlinks=False,
+        one_filesystem=False,
+        onerror=None
+):
+    # Merkle tree of the directory path over its per-file okhashes. Yields (node, digest) pairs in
+    # depth-first post-order: files as './dir/name' with their okhash, directories as './dir/' with
+    # the SHA-256 of their children's names, kinds and digests sorted by name, and the root './' last.
+    # Only open directories are held in memory. Files that cannot be read are passed to onerror and
+    # left out of the tree. With a cache, unchanged files cost a stat, so rebuilding the tree of a
+    # replica mostly reads the files that changed.
+    if not stat.S_ISDIR(os.stat(path).st_mode):
+        raise NotADirectoryError(20, 'Not a directory', path)
+
+    prefix = os.path.join(path, '')
+    walk, hash_walk = tee(walk_files([path], follow_symlinks, one_filesystem, onerror))
+    digests = okhash_many((filepath for filepath, _ in hash_walk), K=K, workers=workers, return_exceptions=True,
+                          cache=cache)
+
+    # directories from the root down to the current one: (path parts, children)
+    stack = [((), [])]
+    for (filepath, _), digest in zip(walk, digests):
+        if isinstance(digest, Exception):
+            if not isinstance(digest, OSError):
+                raise digest
+            if onerror is not None:
+                onerror(digest)
+            continue
+
+        parts = tuple(filepath[len(prefix):].split(os.sep))
+        while stack[-1][0] != parts[:len(stack[-1][0])]:
+            yield _close_tree_node(stack)
+        while len(stack[-1][0]) < len(parts) - 1:
+            stack.append((parts[:len(stack[-1][0]) + 1], []))
+
+        stack[-1][1].append((parts[-1], False, digest))
+        yield './' + '/'.join(parts), digest
+
+    while stack:
+        yield _close_tree_node(stack)
+
+
+def _close_tree_node(stack):
+    parts, children = stack.pop()
+    m = hashlib.sha256()
+    for name, is_dir, digest in sorted(children):
+        name = os.fsencode(name)
+        m.update(struct.pack('<?I', is_dir, len(name)) + name + struct.pack('<H', len(digest)) + digest)
+    digest = m.digest()
+    if stack:
+        stack[-1][1].append((parts[-1], True, digest))
+    return './' + ''.join(part + '/' for part in parts), digest
+
+
+def _tree_parent(node):
+    node = node.rstrip('/')
+    return node[:node.rindex('/') + 1]
+
+
+def write_tree_file(filepath, nodes):
+    # Save (node, digest) pairs as "<hex digest>  <node>" lines, returning the last (root) digest
+    digest = None
+    with open(filepath, 'w', errors='surrogateescape') as fou:
+        for node, digest in nodes:
+            fou.write(f"{digest.hex()}  {node}\n")
+    return digest
+
+
+def load_tree_file(filepath):
+    # {node: digest} of a tree file written by write_tree_file
+    tree = dict()
+    with open(filepath, errors='surrogateescape') as fin:
+        for line_number, line in enumerate(fin, 1):
+            hex_digest, _, node = line.rstrip('\n').partition('  ')
+            if not node.startswith('./') or not _HEX_DIGITS.issuperset(hex_digest) or len(hex_digest) % 2:
+                raise ValueError(f"{filepath}: {line_number}: improperly formatted tree line")
+            tree[node] = bytes.fromhex(hex_digest)
+    return tree
+
+
+def diff_okhash_trees(tree1, tree2):
+    # Compare two {node: digest} trees from the root down, only descending into directories whose
+    # digests differ. Yields (node, status) in sorted order, status being 'changed', 'missing'
+    # (only in tree1) or 'new' (only in tree2); a directory on one side only is reported once.
+    children = defaultdict(list)
+    for node in tree1.keys() | tree2.keys():
+        if node != './':
+            children[_tree_parent(node)].append(node)
+
+    stack = ['./']
+    while stack:
+        node = stack.pop()
+        digest1, digest2 = tree1.get(node), tree2.get(node)
+        if digest1 == digest2:
+            continue
+        if digest1 is None or digest2 is None:
+            yield node, 'new' if digest1 is None else 'missing'
+        elif node.endswith('/'):
+            stack.extend(sorted(children[node], reverse=True))
+        else:
+            yield node, 'changed'
+
+
+def _scandir_sorted(path, onerror):
+    try:
+        with os.scandir(path) as it:
+            return iter(sorted(it, key=lambda entry: entry.name))
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return iter(())
+
+
+def _level_digest_filepath(task):
+    # Digest of a single okhash level of a file, level 0 being a full SHA-256
+    filepath, level = task
     with open(filepath, 'rb') as fin:
-        return okhash(fin, K=K)
+        return _okhash_file(fin, os.fstat(fin.fileno()), 'auto', partial(_level_digest, level), level)
+
+
+def _level_digest(level, input_stream, input_size):
+    input_stream, input_size = _normalize_input(input_stream, input_size)
+    if level:
+        base_size, block_size, count = _level_constants(level)[-1]
+        if input_size > base_size * 2:
+            return _run_requests(_level_requests(input_size, block_size, count),
+                                 partial(_read_stream_at, input_stream, None))
+    input_stream.seek(0)
+    return sha256(input_stream)
+
+
+def _cache_key(st):
+    # sqlite integers are signed 64 bits, some filesystems hand out unsigned 64 bits inode numbers
+    inode = st.st_ino - 2 ** 64 if st.st_ino >= 2 ** 63 else st.st_ino
+    return st.st_dev, inode, st.st_size, st.st_mtime_ns
+
+
+class OKHashCache:
+    # Persistent digest cache stored in SQLite, keyed by (device, inode, size, mtime_ns, K), or kept in
+    # memory with path ':memory:'. A digest computed with a higher K also answers lower K lookups, since
+    # okhashes are downgradable. Least recently used entries are evicted past max_entries.
+    def __init__(self, path, max_entries=DEFAULT_CACHE_ENTRIES, commit_interval=1000):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.hits, self.misses, self.stores, self.evictions = 0, 0, 0, 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS okhashes ("
+            "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, k INTEGER, "
+            "digest BLOB NOT NULL, accessed INTEGER NOT NULL, "
+            "PRIMARY KEY (device, inode, size, mtime_ns, k))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS okhashes_accessed ON okhashes (accessed)")
+        self._clock = self._connection.execute("SELECT COALESCE(MAX(accessed), 0) FROM okhashes").fetchone()[0]
+
+    def get(
+            self,
+            st,
+            K  # noqa
+    ):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT rowid, digest FROM okhashes "
+                "WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND k >= ? ORDER BY k LIMIT 1",
+                (*_cache_key(st), K)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._clock += 1
+            self._connection.execute("UPDATE okhashes SET accessed = ? WHERE rowid = ?", (self._clock, row[0]))
+            self._written()
+            return row[1][:K * SHA256_DIGEST_LEN]
+
+    def put(
+            self,
+            st,
+            K,  # noqa
+            digest
+    ):
+        with self._lock:
+            self.stores += 1
+            self._clock += 1
+            self._connection.execute(
+                "INSERT OR REPLACE INTO okhashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*_cache_key(st), K, digest, self._clock)
+            )
+            self._written()
+
+    def _written(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self._commit()
+
+    def _commit(self):
+        excess = self._entries() - self.max_entries
+        if excess > 0:
+            self._connection.execute(
+                "DELETE FROM okhashes WHERE rowid IN (SELECT rowid FROM okhashes ORDER BY accessed LIMIT ?)",
+                (excess,)
+            )
+            self.evictions += excess
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def _entries(self):
+        return self._connection.execute("SELECT COUNT(*) FROM okhashes").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            self._commit()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'entries': self._entries(),
+            }
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def okhash_server(socket_path, cache=None):
+    # Daemon serving okhash_filepath() to local processes over a Unix socket, so that services on the
+    # same host share one digest cache (an in-memory OKHashCache unless `cache` is given) instead of
+    # each re-reading the same files. Clients are served concurrently, one thread per connection.
+    #
+    # Protocol: JSON lines. Each request is {"K": k, "paths": [...]}, answered by a list holding
+    # {"digest": hex} or {"error": message, "errno": errno} per path, in order. Paths are resolved by
+    # the server, relative paths against its working directory.
+    #
+    # Returns a socketserver server: run it with serve_forever(), stop it with shutdown() from another
+    # thread, and server_close() (or a with block) removes the socket.
+    import socketserver
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                self.wfile.write(_serve_request(line, self.server.cache))
+                self.wfile.flush()
+
+    class _Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def server_close(self):
+            super().server_close()
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+    _remove_stale_socket(socket_path)
+    server = _Server(socket_path, _Handler)
+    server.cache = cache if cache is not None else OKHashCache(':memory:')
+    return server
+
+
+def _serve_request(line, cache):
+    import json
+    try:
+        request = json.loads(line)
+        K, filepaths = request.get('K', DEFAULT_K), request['paths']  # noqa
+        if not isinstance(K, int) or not 1 <= K <= SERVER_MAX_K or not isinstance(filepaths, list) \
+                or not all(isinstance(filepath, str) for filepath in filepaths):
+            raise ValueError
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return json.dumps({'error': 'Invalid request'}).encode('utf-8') + b'\n'
+
+    results = list()
+    for filepath in filepaths:
+        try:
+            results.append({'digest': okhash_filepath(filepath, K=K, cache=cache).hex()})
+        except OSError as e:
+            results.append({'error': e.strerror, 'errno': e.errno})
+        except Exception as e:
+            results.append({'error': str(e)})
+    return json.dumps(results).encode('utf-8') + b'\n'
+
+
+def _remove_stale_socket(socket_path):
+    # a socket left behind by a daemon that did not exit cleanly, nothing listening on it anymore
+    import socket
+    if not os.path.lexists(socket_path) or not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+
+
+def okhash_remote(
+        socket_path,
+        filepaths,
+        K=DEFAULT_K,  # noqa
+        return_exceptions=False,
+        batch_size=1024
+):
+    # Client of okhash_server: yields the digests of filepaths in input order, requested in batches of
+    # batch_size paths. Paths are made absolute, since the server does not share our working directory.
+    import json
+    import socket
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rwb') as stream:
+            filepaths = iter(filepaths)
+            while True:
+                batch = [os.path.abspath(filepath) for _, filepath in zip(range(batch_size), filepaths)]
+                if not batch:
+                    return
+
+                stream.write(json.dumps({'K': K, 'paths': batch}).encode('utf-8') + b'\n')
+                stream.flush()
+                results = json.loads(stream.readline() or b'null')
+                if not isinstance(results, list):
+                    raise ValueError(f"okhash server error: {results['error'] if results else 'connection closed'}")
+
+                for filepath, result in zip(batch, results):
+                    if 'digest' in result:
+                        yield bytes.fromhex(result['digest'])
+                        continue
+
+                    if 'errno' in result:
+                        e = OSError(result['errno'], result['error'], filepath)
+                    else:
+                        e = ValueError(result['error'])
+                    if not return_exceptions:
+                        raise e
+                    yield e
+
+
+class RangeReader:
+    # seek/read/tell over any random-access source of byte ranges, read_range(offset, length) returning
+    # exactly those bytes, such as the HTTP Range requests of okhash_url. Reads go through an LRU cache
+    # of block_size aligned blocks, cache_bytes in total, and each contiguous run of blocks a read is
+    # missing is fetched with a single read_range call: adjacent blocks are coalesced into one request
+    # instead of one each, cached blocks are never fetched again.
+    def __init__(self, read_range, size, block_size=RANGE_BLOCK_SIZE, cache_bytes=RANGE_CACHE_BYTES):
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1")
+        self.read_range = read_range
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max(1, cache_bytes // block_size)
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.requests, self.bytes_fetched = 0, 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0 or start + size > self.size:
+            size = max(0, self.size - start)
+        end = start + size
+        self.position = end
+        if not size:
+            return b''
+
+        # blocks are collected before fetching, which may evict some of them when a read outgrows the cache
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        blocks = dict()
+        for ix in range(first, last + 1):
+            if ix in self.blocks:
+                self.blocks.move_to_end(ix)
+                blocks[ix] = self.blocks[ix]
+
+        runs = list()
+        for ix in range(first, last + 1):
+            if ix in blocks:
+                continue
+            if runs and runs[-1][1] == ix:
+                runs[-1][1] = ix + 1
+            else:
+                runs.append([ix, ix + 1])
+
+        for run_first, run_end in runs:
+            offset = run_first * self.block_size
+            data = self.read_range(offset, min(self.size, run_end * self.block_size) - offset)
+            self.requests += 1
+            self.bytes_fetched += len(data)
+            for ix in range(run_first, run_end):
+                block = data[(ix - run_first) * self.block_size:(ix - run_first + 1) * self.block_size]
+                blocks[ix] = block
+                self.blocks[ix] = block
+                if len(self.blocks) > self.max_blocks:
+                    self.blocks.popitem(last=False)
+
+        data = b''.join(blocks[ix] for ix in range(first, last + 1))
+        return memoryview(data)[start - first * self.block_size:end - first * self.block_size]
+
+
+class _HTTPConnectionPool:
+    # Idle keep-alive connections per (scheme, host), shared by all okhash_url calls and their threads
+    def __init__(self, max_idle=HTTP_MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc, path, headers, timeout):
+        # GET returning (response, body). The body of a 200 response to a Range request is the whole
+        # object, left unread: its connection is closed instead.
+        import http.client
+        while True:
+            with self.lock:
+                connection = self.idle[scheme, netloc].pop() if self.idle[scheme, netloc] else None
+            reused = connection is not None
+            if connection is None:
+                connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+                connection = connection_class(netloc, timeout=timeout)
+
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                if response.status == 200 and 'Range' in headers:
+                    connection.close()
+                    return response, b''
+                body = response.read()
+            except (ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if reused:
+                    # closed by the server while idle in the pool: retry on another connection
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+            with self.lock:
+                if response.will_close or len(self.idle[scheme, netloc]) >= self.max_idle:
+                    connection.close()
+                else:
+                    self.idle[scheme, netloc].append(connection)
+            return response, body
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+_http_pool = _HTTPConnectionPool()
+
+
+def _http_range_source(url, timeout=HTTP_TIMEOUT, headers=None):
+    # (read_range, size) of an HTTP(S) object. The size comes from a one byte Range request rather than
+    # a HEAD, which pre-signed GET URLs do not allow; its validator then guards every later request, so
+    # an object replaced while being hashed fails instead of mixing blocks of two versions. If-Match only
+    # takes strong ETags, weak ones (W/"...", common behind compression or CDNs) fall back to
+    # If-Unmodified-Since with the Last-Modified date.
+    from urllib.parse import urlsplit
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        raise ValueError("url must be an http or https URL")
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    headers = dict(headers or {})
+
+    response, _ = _http_pool.get(parts.scheme, parts.netloc, path, dict(headers, Range='bytes=0-0'), timeout)
+    if response.status == 200:
+        raise OSError(f"{url}: the server does not support range requests")
+    if response.status not in (206, 416):
+        raise OSError(f"{url}: HTTP {response.status} {response.reason}")
+    # 'bytes 0-0/SIZE', or 'bytes */0' for an empty object (416)
+    total = (response.getheader('Content-Range') or '').rpartition('/')[2]
+    if not total.isdigit():
+        raise OSError(f"{url}: the server did not send the object size")
+    size = int(total)
+    etag = response.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        headers['If-Match'] = etag
+    elif response.getheader('Last-Modified'):
+        headers['If-Unmodified-Since'] = response.getheader('Last-Modified')
+
+    def _read_range(offset, length):
+        range_response, data = _http_pool.get(
+            parts.scheme, parts.netloc, path, dict(headers, Range=f'bytes={offset}-{offset + length - 1}'), timeout
+        )
+        if range_response.status == 412:
+            raise OSError(f"{url}: the object changed while being hashed")
+        if range_response.status != 206:
+            raise OSError(f"{url}: HTTP {range_response.status} {range_response.reason}")
+        if not (range_response.getheader('Content-Range') or '').startswith(f'bytes {offset}-') or len(data) != length:
+            raise OSError(f"{url}: unexpected range in the response")
+        return data
+
+    return _read_range, size
+
+
+def okhash_url(
+        url,
+        K=DEFAULT_K,  # noqa
+        stats=None,
+        profile=None,
+        headers=None,
+        timeout=HTTP_TIMEOUT
+):
+    # okhash of an HTTP(S) object without downloading it: the sampled blocks are read with Range
+    # requests over pooled keep-alive connections, through a RangeReader. A multi-GB object takes one
+    # request per block, e.g. 1 + 255 at K=2 (the first block is shared by all levels), only objects
+    # small enough for the full SHA-256 fallback are downloaded whole. The server must answer Range
+    # requests with 206 responses; headers are sent with every request, e.g. for authorization.
+    read_range, size = _http_range_source(url, timeout, headers)
+    return okhash(RangeReader(read_range, size), size, K=K, stats=stats, profile=profile)
 
 
 def compare_okhashes(hash1, hash2):  # , K=None):
+    # okhashes of hash profiles that do not share their first levels are not comparable
+    header1, hash1 = _split_profile(hash1)
+    header2, hash2 = _split_profile(hash2)
+
     # how to check with the same K level, and check if K is downgradable?
     # if K is None:
     # Deduce K from the size of the smallest hash
     K = min(len(hash1), len(hash2)) // SHA256_DIGEST_LEN
+    if not _compatible_headers(header1, header2, K):
+        raise ProfileMismatchError("okhashes computed with different hash profiles cannot be compared")
 
     digest_len = K * SHA256_DIGEST_LEN
 
@@ -132,8 +1830,19 @@ def compare_okhashes(hash1, hash2):  # , K=None):
     return cropped_hash1 == cropped_hash2
 
 
-def sha256(input_stream, chunk_size=8192):
-    sha256_hash = hashlib.sha256()
+def sha256(input_stream, chunk_size=FALLBACK_CHUNK_SIZE, new_hash=hashlib.sha256):
+    # Full SHA-256 (or new_hash) of the stream from its current position to the end, the fallback of small inputs
+    if isinstance(input_stream, _MemoryViewReader):
+        # already in memory: a single update lets hashlib release the GIL over the whole buffer
+        return new_hash(input_stream.read()).digest()
+
+    fd, offset, size = _regular_file_range(input_stream)
+    if fd is not None:
+        digest = _sha256_fd(fd, offset, size, chunk_size, new_hash)
+        input_stream.seek(0, 2)
+        return digest
+
+    sha256_hash = new_hash()
 
     while True:
         data = input_stream.read(chunk_size)
@@ -144,29 +1853,184 @@ def sha256(input_stream, chunk_size=8192):
     return sha256_hash.digest()
 
 
-def load_hash_files(filepath):
-    global status_code, format_errors
+def _regular_file_range(input_stream):
+    # (fd, position, size) of streams that can be read with os.preadv, (None, None, None) otherwise
+    if isinstance(input_stream, _PreadReader):
+        return input_stream.fd, input_stream.tell(), input_stream.size
+    if not hasattr(os, 'preadv') or not isinstance(input_stream, (io.BufferedReader, io.FileIO)):
+        return None, None, None
+    st = os.fstat(input_stream.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        return None, None, None
+    return input_stream.fileno(), input_stream.tell(), st.st_size
+
+
+def _sha256_fd(fd, offset, size, chunk_size=FALLBACK_CHUNK_SIZE, new_hash=hashlib.sha256):
+    # SHA-256 of fd from offset to EOF with page aligned os.preadv reads. Past two chunks, a reader
+    # thread fills one buffer while the other is hashed: both preadv and hashlib release the GIL,
+    # so reading the next chunk overlaps hashing the current one.
+    chunk_size = max(mmap.PAGESIZE, chunk_size - chunk_size % mmap.PAGESIZE)
+    m = new_hash()
+
+    if size - offset <= 2 * chunk_size:
+        buffer = bytearray(chunk_size)
+        while True:
+            n = os.preadv(fd, [buffer], offset)
+            if not n:
+                return m.digest()
+            m.update(memoryview(buffer)[:n])
+            offset += n
+
+    import queue
+    free, filled = queue.Queue(), queue.Queue()
+    free.put(bytearray(chunk_size))
+    free.put(bytearray(chunk_size))
+
+    def _reader(position):
+        try:
+            while True:
+                buffer = free.get()
+                if buffer is None:
+                    return
+                n = os.preadv(fd, [buffer], position)
+                filled.put((buffer, n))
+                if not n:
+                    return
+                position += n
+        except Exception as e:
+            filled.put(e)
+
+    reader = threading.Thread(target=_reader, args=(offset,), daemon=True)
+    reader.start()
     try:
-        with open(filepath) as fin:
-            lines = fin.readlines()
-    except PermissionError as e:
-        print(f"okhash.py: {filepath}: Permission denied", file=sys.stderr)
-        status_code = 1
-        return []
+        while True:
+            item = filled.get()
+            if isinstance(item, Exception):
+                raise item
+            buffer, n = item
+            if not n:
+                return m.digest()
+            m.update(memoryview(buffer)[:n])
+            free.put(buffer)
+    finally:
+        free.put(None)
+        reader.join()
+
+
+class BinaryManifest:
+    # Read-only view of a binary manifest written by write_binary_manifest, memory-mapped so that
+    # opening it is O(1) and lookup() is a binary search over the records sorted by path.
+    #
+    # Layout (little-endian): header (magic, version, max levels, reserved, record count), then one
+    # fixed-width record per entry (levels, digest zero-padded to max levels, path offset, path length),
+    # sorted by path, then the path table (file system encoded paths, concatenated).
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as fin:
+            self._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.max_levels, _, self.count = _MANIFEST_HEADER.unpack_from(
+            self._mm.read(_MANIFEST_HEADER.size).ljust(_MANIFEST_HEADER.size, b'\x00')
+        )
+        if magic != BINARY_MANIFEST_MAGIC or version != 1:
+            self._mm.close()
+            raise ValueError(f"{filepath} is not a binary O(K)hash manifest")
+
+        self._record = struct.Struct(f'<B{self.max_levels * SHA256_DIGEST_LEN}sQI')
+        self._paths_offset = _MANIFEST_HEADER.size + self.count * self._record.size
+
+    def __len__(self):
+        return self.count
+
+    def _path_bytes(self, ix):
+        _, _, path_offset, path_len = self._record.unpack_from(self._mm, _MANIFEST_HEADER.size + ix * self._record.size)
+        start = self._paths_offset + path_offset
+        return self._mm[start:start + path_len]
+
+    def _entry(self, ix):
+        levels, digest, path_offset, path_len = self._record.unpack_from(
+            self._mm, _MANIFEST_HEADER.size + ix * self._record.size
+        )
+        start = self._paths_offset + path_offset
+        return digest[:levels * SHA256_DIGEST_LEN], os.fsdecode(self._mm[start:start + path_len])
+
+    def __iter__(self):
+        for ix in range(self.count):
+            yield self._entry(ix)
+
+    def lookup(self, filepath):
+        # digests of every entry of filepath (usually one)
+        path = os.fsencode(filepath)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path_bytes(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
 
-    result = list()
+        digests = list()
+        while lo < self.count and self._path_bytes(lo) == path:
+            digests.append(self._entry(lo)[0])
+            lo += 1
+        return digests
 
-    def _validate_hash(_hash):
-        hex_pattern = re.compile(r'^[0-9a-fA-F]+$')
+    def close(self):
+        self._mm.close()
 
-        if not hex_pattern.match(_hash):
-            return False
+    def __enter__(self):
+        return self
 
-        if not _hash or len(_hash) % 64 != 0:
-            return False
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-        return True
 
+def write_binary_manifest(filepath, entries):
+    # Write (digest, filepath) entries as a binary manifest, see BinaryManifest
+    records = sorted((os.fsencode(entry_filepath), digest) for digest, entry_filepath in entries)
+    if any(not digest or len(digest) % SHA256_DIGEST_LEN for _, digest in records):
+        raise ValueError("digests must be a non-zero multiple of the SHA-256 digest length")
+
+    max_levels = max((len(digest) // SHA256_DIGEST_LEN for _, digest in records), default=1)
+    record = struct.Struct(f'<B{max_levels * SHA256_DIGEST_LEN}sQI')
+
+    with open(filepath, 'wb') as fou:
+        fou.write(_MANIFEST_HEADER.pack(BINARY_MANIFEST_MAGIC, 1, max_levels, 0, len(records)))
+        path_offset = 0
+        for path, digest in records:
+            fou.write(record.pack(len(digest) // SHA256_DIGEST_LEN, digest, path_offset, len(path)))
+            path_offset += len(path)
+        for path, _ in records:
+            fou.write(path)
+
+
+def iter_hash_file(filepath, on_format_error=None, only=None):
+    # Lazily yield the (digest, filepath) entries of a text ('-' for stdin) or binary manifest.
+    # on_format_error(line_number) is called for improperly formatted text lines. With `only`,
+    # just the entries of those paths are yielded, looked up by binary search in binary manifests.
+    only_set = None if only is None else set(only)
+    if filepath == '-':
+        yield from _parse_hash_lines(sys.stdin, on_format_error, only_set)
+        return
+
+    # opened once: a pipe (okhash -c <(...)) cannot be read again after checking for the binary magic
+    with open(filepath, 'rb') as fin:
+        if stat.S_ISREG(os.fstat(fin.fileno()).st_mode):
+            binary = fin.read(len(BINARY_MANIFEST_MAGIC)) == BINARY_MANIFEST_MAGIC
+            fin.seek(0)
+            if binary:
+                with BinaryManifest(filepath) as manifest:
+                    if only is None:
+                        yield from manifest
+                    else:
+                        for only_filepath in only:
+                            for digest in manifest.lookup(only_filepath):
+                                yield digest, only_filepath
+                return
+
+        yield from _parse_hash_lines(io.TextIOWrapper(fin), on_format_error, only_set)
+
+
+def _parse_hash_lines(lines, on_format_error, only):
     for ix, line in enumerate(lines):
         skip, error = False, False
         if not line.strip():
@@ -176,25 +2040,172 @@ def load_hash_files(filepath):
         if len(splits) != 2:
             error = True
 
-        if not len(splits) >= 2 or not _validate_hash(splits[0]):
+        if not len(splits) >= 2 or not _is_hex_hash(splits[0]):
             error, skip = True, True
 
-        if error:
-            format_errors += 1
-            if not args.quiet:
-                print(f"okhash.py: {filepath}: {ix + 1}: improperly formatted O(K)hash checksum line",
-                      file=sys.stderr)
-            if args.strict:
-                status_code = 1
+        if error and on_format_error is not None:
+            on_format_error(ix + 1)
 
-        if not skip:
-            result.append((bytes.fromhex(splits[0]), splits[1]))
+        if not skip and (only is None or splits[1] in only):
+            yield bytes.fromhex(splits[0]), splits[1]
 
-    return result
+
+def _is_hex_hash(_hash):
+    return bool(_hash) and len(_hash) % 64 == 0 and _HEX_DIGITS.issuperset(_hash)
+
+
+def iter_file_list(filepath, separator=b'\n'):
+    # Paths listed in filepath ('-' for stdin), read in chunks and yielded as they come, so that
+    # lists of millions of paths are never held in memory. Empty entries are skipped.
+    fin = sys.stdin.buffer if filepath == '-' else open(filepath, 'rb')
+    try:
+        pending = b''
+        while True:
+            chunk = fin.read1(1024 * 1024)
+            if not chunk:
+                break
+            paths = (pending + chunk).split(separator)
+            pending = paths.pop()
+            for path in paths:
+                if path:
+                    yield os.fsdecode(path)
+        if pending:
+            yield os.fsdecode(pending)
+    finally:
+        if fin is not sys.stdin.buffer:
+            fin.close()
+
+
+def load_hash_files(filepath, only=None):
+    global status_code
+
+    def _format_error(line_number):
+        global status_code, format_errors
+        format_errors += 1
+        if not args.quiet:
+            print(f"okhash.py: {filepath}: {line_number}: improperly formatted O(K)hash checksum line",
+                  file=sys.stderr)
+        if args.strict:
+            status_code = 1
+
+    try:
+        yield from iter_hash_file(filepath, _format_error, only)
+    except PermissionError as e:
+        print(f"okhash.py: {filepath}: Permission denied", file=sys.stderr)
+        status_code = 1
+
+
+class _ProgressReporter:
+    # Live progress line on a terminal's stderr and periodic metrics file, both refreshed from a
+    # background thread out of snapshot(), a callable returning the run's counters. While running,
+    # it stands in for sys.stderr so that messages printed meanwhile erase the progress line first.
+    def __init__(self, snapshot, total_files=None, stream=None, metrics_path=None, metrics_format='prometheus'):
+        self.snapshot = snapshot
+        self.total_files = total_files
+        self.stream = stream
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._drawn = False
+        self._stderr = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.stream is not None:
+            self._stderr, sys.stderr = sys.stderr, self
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self.stream is not None:
+            sys.stderr = self._stderr
+            self._draw(final=True)
+        if self.metrics_path is not None:
+            _write_metrics(self.metrics_path, self.metrics(running=False), self.metrics_format)
+
+    def write(self, text):
+        with self._lock:
+            if self._drawn:
+                self.stream.write('\r\x1b[K')
+                self._drawn = False
+            return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def metrics(self, running=True):
+        return {**self.snapshot(), 'seconds': time.monotonic() - self.started, 'running': int(running)}
+
+    def _run(self):
+        metrics_written = 0
+        while not self._stop.wait(PROGRESS_INTERVAL):
+            if self.stream is not None:
+                self._draw()
+            if self.metrics_path is not None and time.monotonic() - metrics_written >= METRICS_INTERVAL:
+                _write_metrics(self.metrics_path, self.metrics(), self.metrics_format)
+                metrics_written = time.monotonic()
+
+    def _draw(self, final=False):
+        metrics = self.metrics()
+        files, seconds = metrics['files'], metrics['seconds']
+        line = f"okhash.py: {files} files, {_format_bytes(metrics['bytes_read'])} sampled, " \
+               f"{files / seconds:.1f} files/s, {_format_bytes(metrics['bytes_read'] / seconds)}/s"
+        if self.total_files is not None:
+            # files that could not be read are done too
+            done = files + metrics['file_errors']
+            line = line.replace(f" {files} files", f" {done}/{self.total_files} files", 1)
+            if done and not final:
+                line += f", ETA {_format_duration((self.total_files - done) * seconds / done)}"
+        errors = metrics['format_errors'] + metrics['file_errors'] + metrics['checksum_errors']
+        if errors:
+            line += f", {errors} errors"
+
+        with self._lock:
+            self.stream.write('\r\x1b[K' + line + ('\n' if final else ''))
+            self.stream.flush()
+            self._drawn = not final
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def _write_metrics(filepath, metrics, metrics_format='prometheus'):
+    # Prometheus text format (for the node exporter textfile collector) or JSON, written to a
+    # temporary file then renamed over filepath, so that readers never see a partial file
+    if metrics_format == 'json':
+        import json
+        content = json.dumps(metrics) + '\n'
+    else:
+        lines = list()
+        for key, value in metrics.items():
+            name, metric_type = (f'okhash_{key}', 'gauge') if key in ('seconds', 'running') else \
+                (f'okhash_{key}_total', 'counter')
+            lines.extend((f"# TYPE {name} {metric_type}", f"{name} {value}"))
+        content = '\n'.join(lines) + '\n'
+
+    temp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(temp_filepath, 'w') as fou:
+        fou.write(content)
+    os.replace(temp_filepath, filepath)
 
 
 def parse_args():
     global args
+    import argparse
     parser = argparse.ArgumentParser(
         description="Print or check O(K)Hash checksums.",
         usage="python3 -m okhash [OPTION]... [FILE]...",
@@ -211,12 +2222,170 @@ line with checksum, a space, and name for each FILE.
         help='Strength of the Hash'
     )
 
+    parser.add_argument(
+        '--profile',
+        metavar='SPEC',
+        help="custom sampling budget replacing -K: comma separated BASE:BLOCK sizes, one pair per level, "
+             "e.g. '1M:1K,64M:64K' (K, M, G and T suffixes are binary); recorded in the checksums, which "
+             "can only be checked with the same --profile"
+    )
+
+    parser.add_argument(
+        '--algorithm',
+        metavar='NAME',
+        default='sha256',
+        help=f"digest algorithm: {', '.join(DIGEST_ALGORITHMS)} or blake3 (needs the blake3 package); anything "
+             f"but the default sha256 is recorded in the checksums like a --profile (default: %(default)s)"
+    )
+
     parser.add_argument(
         '-c', '--check',
         action='store_true',
         help='read O(K)Hash sums from the FILEs and check them'
     )
 
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='number of files to hash in parallel (default: 1)'
+    )
+
+    parser.add_argument(
+        '--cache',
+        metavar='PATH',
+        help='reuse O(K)hashes of unchanged files from (and store new ones in) this cache database'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_CACHE_ENTRIES,
+        metavar='N',
+        help=f'maximum number of cached O(K)hashes (default: {DEFAULT_CACHE_ENTRIES})'
+    )
+
+    parser.add_argument(
+        '--cache-stats',
+        action='store_true',
+        help='print cache hits, misses and evictions to stderr when done'
+    )
+
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='print a JSON summary of I/O statistics (blocks, seeks, bytes read, time per K level) to stderr'
+    )
+
+    parser.add_argument(
+        '--stats-per-file',
+        action='store_true',
+        help='like --stats, also printing one JSON line per file'
+    )
+
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        help='show files hashed, bytes sampled, files/s and ETA on stderr, if it is a terminal'
+    )
+
+    parser.add_argument(
+        '--metrics',
+        metavar='PATH',
+        help=f'keep run counters (files, bytes read, fallbacks, errors) in PATH, rewritten every '
+             f'{METRICS_INTERVAL} seconds and at the end'
+    )
+
+    parser.add_argument(
+        '--metrics-format',
+        choices=METRICS_FORMATS,
+        default='prometheus',
+        help='format of the --metrics file: Prometheus text format (default) or JSON'
+    )
+
+    parser.add_argument(
+        '-r', '--recursive',
+        action='store_true',
+        help='hash the files under directory FILEs recursively'
+    )
+
+    parser.add_argument(
+        '-L', '--follow-symlinks',
+        action='store_true',
+        help='follow symbolic links when walking directories'
+    )
+
+    parser.add_argument(
+        '-x', '--one-file-system',
+        action='store_true',
+        help="don't descend into directories on other file systems"
+    )
+
+    parser.add_argument(
+        '--seek-order',
+        action='store_true',
+        help='hash files in batches with their sampled reads interleaved and sorted by position on disk, '
+             'for rotational or tape-backed storage (replaces --jobs)'
+    )
+
+    parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        help='run as a daemon answering okhash requests on the Unix socket SOCKET, sharing an in-memory '
+             'cache of up to --cache-size digests (or the --cache database) between all clients'
+    )
+
+    parser.add_argument(
+        '--tree',
+        action='store_true',
+        help='print one Merkle digest per directory FILE, built over the O(K)hashes of the files under it'
+    )
+
+    parser.add_argument(
+        '--tree-file',
+        metavar='PATH',
+        help='with --tree, save the digests of all the files and directories of the tree to PATH'
+    )
+
+    parser.add_argument(
+        '--compare-tree',
+        metavar='PATH',
+        help='with --tree, compare the tree with one saved by --tree-file, printing the files and '
+             'directories that differ'
+    )
+
+    parser.add_argument(
+        '--find-duplicates',
+        action='store_true',
+        help='search the FILEs and directories (default: .) for duplicate files and print them in groups, '
+             'hashing only files of equal size and escalating up to K only while they still collide'
+    )
+
+    parser.add_argument(
+        '--full-hash',
+        action='store_true',
+        help='with --find-duplicates, confirm duplicates with a SHA-256 of the whole files'
+    )
+
+    parser.add_argument(
+        '--binary-manifest',
+        metavar='PATH',
+        help='also write the computed O(K)hashes to PATH as a binary manifest, which --check reads as well'
+    )
+
+    parser.add_argument(
+        '--files-from',
+        metavar='LIST',
+        help="also read FILEs from LIST ('-' for stdin), one per line, e.g. to hash millions of files "
+             "in a single process"
+    )
+
+    parser.add_argument(
+        '-0', '--null',
+        action='store_true',
+        help='FILEs in --files-from are separated by NUL, not newline (find -print0)'
+    )
+
     parser.add_argument(
         '-z', '--zero',
         action='store_true',
@@ -224,6 +2393,13 @@ line with checksum, a space, and name for each FILE.
     )
 
     verify_group = parser.add_argument_group(title='Useful only when verifying checksums')
+    verify_group.add_argument(
+        '--only',
+        action='append',
+        metavar='PATH',
+        help="only check the entries of PATH (can be repeated), looked up by binary search in binary manifests"
+    )
+
     verify_group.add_argument(
         '--ignore-missing',
         action='store_true',
@@ -265,8 +2441,7 @@ line with checksum, a space, and name for each FILE.
         'files',
         metavar='FILE',
         nargs='*',
-        default=['-'],
-        help='Files to compute or check O(K)hashes (default: stdin)'
+        help='Files to compute or check O(K)hashes (default: stdin, unless --files-from is given)'
     )
 
     return parser.parse_args()
@@ -274,16 +2449,7 @@ line with checksum, a space, and name for each FILE.
 
 def main():
     global status_code, args, format_errors, file_errors, checksum_errors
-
-    def _read_stdin():
-        data = b''
-        while True:
-            chunk = sys.stdin.buffer.read(1024 * 1024)
-            if not chunk:
-                break
-            data += chunk
-
-        return data
+    import json
 
     def _print_result(_filepath, _result):
         if args.status:
@@ -295,21 +2461,237 @@ def main():
         print(f"{_filepath}: {_result}")
 
     args = parse_args()
-    filepaths = args.files
+    if args.files_from is not None:
+        if args.files_from == '-' and '-' in args.files:
+            print("okhash.py: --files-from - cannot be used with stdin as a FILE", file=sys.stderr)
+            sys.exit(2)
+        filepaths = chain(args.files, iter_file_list(args.files_from, separator=b'\x00' if args.null else b'\n'))
+    else:
+        filepaths = args.files or ['-']
+
+    if args.K < 1:
+        print("okhash.py: -K must be at least 1", file=sys.stderr)
+        sys.exit(2)
+
+    if args.jobs < 1:
+        print("okhash.py: --jobs must be at least 1", file=sys.stderr)
+        sys.exit(2)
+
+    if args.cache_size < 1:
+        print("okhash.py: --cache-size must be at least 1", file=sys.stderr)
+        sys.exit(2)
+
+    if args.recursive and args.check:
+        print("okhash.py: --recursive cannot be used with --check", file=sys.stderr)
+        sys.exit(2)
+
+    if (args.tree_file or args.compare_tree) and not args.tree:
+        print("okhash.py: --tree-file and --compare-tree require --tree", file=sys.stderr)
+        sys.exit(2)
+
+    if args.tree and (args.check or (args.tree_file or args.compare_tree) and len(args.files) != 1):
+        print("okhash.py: --tree cannot be used with --check, and --tree-file and --compare-tree take a single "
+              "directory", file=sys.stderr)
+        sys.exit(2)
+
+    profile = None
+    if args.profile or args.algorithm != 'sha256':
+        try:
+            if args.profile:
+                profile = HashProfile.parse(args.profile)
+                if args.algorithm != 'sha256':
+                    profile = HashProfile(((base_size, block_size) for base_size, block_size, _ in profile.levels),
+                                          args.algorithm)
+            else:
+                profile = HashProfile.standard(args.K, args.algorithm)
+        except ValueError as e:
+            print(f"okhash.py: --{'profile' if args.profile else 'algorithm'}: {e}", file=sys.stderr)
+            sys.exit(2)
+        if args.cache or args.seek_order or args.tree or args.serve or args.find_duplicates:
+            print("okhash.py: --profile and --algorithm cannot be used with --cache, --seek-order, --tree, "
+                  "--serve or --find-duplicates", file=sys.stderr)
+            sys.exit(2)
+
+    if args.seek_order and (args.check or args.cache or args.stats or args.stats_per_file or args.progress or
+                            args.metrics):
+        print("okhash.py: --seek-order cannot be used with --check, --cache, --stats, --progress or --metrics",
+              file=sys.stderr)
+        sys.exit(2)
+
+    cache = OKHashCache(args.cache, max_entries=args.cache_size) if args.cache else None
+
+    if args.serve:
+        try:
+            server = okhash_server(args.serve, cache=cache or OKHashCache(':memory:', max_entries=args.cache_size))
+        except OSError as e:
+            print(f"okhash.py: {args.serve}: {e.strerror}", file=sys.stderr)
+            sys.exit(1)
+
+        with server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        server.cache.close()
+        sys.exit(0)
+
+    def _walk_error(_error):
+        global status_code
+        reason = 'Permission denied' if isinstance(_error, PermissionError) else _error.strerror
+        print(f"okhash.py: {_error.filename}: {reason}", file=sys.stderr)
+        status_code = 1
 
-    for filepath in filepaths:
+    stats_lock = threading.Lock()
+    stats_summary = {'files': 0, 'cached': 0, 'fallback': 0, 'blocks': 0, 'seeks': 0, 'bytes_read': 0,
+                     'seconds': 0.0, 'levels': dict()}
+
+    def _record_stats(_filepath, _stats):
+        with stats_lock:
+            if args.stats_per_file:
+                print(json.dumps({'file': _filepath, **_stats.as_dict()}), file=sys.stderr)
+
+            stats_summary['files'] += 1
+            stats_summary['cached'] += _stats.cached
+            stats_summary['fallback'] += _stats.fallback
+            for level in _stats.levels:
+                level_summary = stats_summary['levels'].setdefault(
+                    level['k'], {'blocks': 0, 'seeks': 0, 'bytes_read': 0, 'seconds': 0.0, 'fallback': 0}
+                )
+                for key in ('blocks', 'seeks', 'bytes_read', 'seconds', 'fallback'):
+                    level_summary[key] += level[key]
+                    if key != 'fallback':
+                        stats_summary[key] += level[key]
+
+    args.stats = args.stats or args.stats_per_file
+    show_progress = args.progress and sys.stderr.isatty()
+    on_stats = _record_stats if args.stats or show_progress or args.metrics else None
+
+    # error counters are reset for each FILE: totals of the previous ones, folded in before each reset
+    error_totals = {'format_errors': 0, 'file_errors': 0, 'checksum_errors': 0}
+
+    def _fold_errors():
+        error_totals['format_errors'] += format_errors
+        error_totals['file_errors'] += file_errors
+        error_totals['checksum_errors'] += checksum_errors
+
+    def _metrics_snapshot():
+        with stats_lock:
+            return {
+                'files': stats_summary['files'],
+                'bytes_read': stats_summary['bytes_read'],
+                'fallback': stats_summary['fallback'],
+                'cached': stats_summary['cached'],
+                'format_errors': error_totals['format_errors'] + format_errors,
+                'file_errors': error_totals['file_errors'] + file_errors,
+                'checksum_errors': error_totals['checksum_errors'] + checksum_errors,
+            }
+
+    if args.find_duplicates:
+        search_paths = list()
+        for filepath in (['.'] if filepaths == ['-'] else filepaths):
+            if exists(filepath):
+                search_paths.append(filepath)
+            else:
+                print(f"okhash.py: {filepath}: No such file or directory", file=sys.stderr)
+                status_code = 1
+
+        end = '\x00' if args.zero else '\n'
+        for group in find_duplicates(search_paths, K=args.K, full_hash=args.full_hash, workers=args.jobs,
+                                     follow_symlinks=args.follow_symlinks, one_filesystem=args.one_file_system,
+                                     onerror=_walk_error):
+            for filepath in sorted(group):
+                print(filepath, end=end)
+            print(end=end)
+        sys.exit(status_code)
+
+    if args.tree:
+        end = '\x00' if args.zero else '\n'
+        for filepath in (['.'] if filepaths == ['-'] else filepaths):
+            try:
+                nodes = okhash_tree(filepath, K=args.K, workers=args.jobs, cache=cache,
+                                    follow_symlinks=args.follow_symlinks, one_filesystem=args.one_file_system,
+                                    onerror=_walk_error)
+                tree = dict()
+                if args.compare_tree:
+                    saved_tree = load_tree_file(args.compare_tree)
+                    nodes = ((node, tree.setdefault(node, digest)) for node, digest in nodes)
+                root_digest = write_tree_file(args.tree_file, nodes) if args.tree_file else \
+                    next(digest for node, digest in nodes if node == './')
+            except OSError as e:
+                print(f"okhash.py: {e.filename or filepath}: {e.strerror}", file=sys.stderr)
+                status_code = 1
+                continue
+            except ValueError as e:
+                print(f"okhash.py: {e}", file=sys.stderr)
+                status_code = 1
+                continue
+
+            print(f"{root_digest.hex()}  {filepath}", end=end)
+            if args.compare_tree:
+                for node, difference in diff_okhash_trees(saved_tree, tree):
+                    print(f"{node}: {difference.upper()}")
+                    status_code = 1
+        sys.exit(status_code)
+
+    def _inputs():
+        # (filepath, exists) pairs, each argument stat-ed once; with --recursive, directories are
+        # expanded lazily from the walker, whose stat results make any further existence check redundant
+        for _filepath in filepaths:
+            if args.recursive and _filepath != '-' and os.path.isdir(_filepath):
+                for _entry_filepath, _ in walk_files([_filepath], args.follow_symlinks, args.one_file_system,
+                                                     _walk_error):
+                    yield _entry_filepath, True
+            else:
+                yield _filepath, _filepath == '-' or exists(_filepath)
+
+    inputs = _inputs()
+    digests = None
+    if not args.check:
+        # the hash workers read ahead of the ordered output loop below by a bounded number of files
+        inputs, hash_inputs = tee(inputs)
+        hash_filepaths = (fp for fp, fp_exists in hash_inputs if fp_exists and fp != '-')
+        if args.seek_order:
+            digests = okhash_scheduled(hash_filepaths, K=args.K, return_exceptions=True)
+        else:
+            digests = okhash_many(hash_filepaths, K=args.K, workers=args.jobs, return_exceptions=True,
+                                  cache=cache, on_stats=on_stats, profile=profile)
+
+    write = sys.stdout.write
+    manifest_entries = list() if args.binary_manifest and not args.check else None
+    end_of_line = '\x00' if args.zero else '\n'
+    progress = None
+    if show_progress or args.metrics:
+        total_files = len(filepaths) if not args.check and not args.recursive and isinstance(filepaths, list) else None
+        progress = _ProgressReporter(_metrics_snapshot, total_files, sys.stderr if show_progress else None,
+                                     args.metrics, args.metrics_format).start()
+
+    for filepath, filepath_exists in inputs:
+        _fold_errors()
         format_errors, file_errors, checksum_errors = 0, 0, 0
 
-        if not exists(filepath):
+        if not filepath_exists:
             print(f"okhash.py: {filepath}: No such file or directory", file=sys.stderr)
+            file_errors += 1
             status_code = 1
             continue
 
         if args.check:
-            entries = load_hash_files(filepath)
-
-            for expected_hash, entry_filepath in entries:
-                if not exists(entry_filepath):
+            # entries are parsed lazily and verified on the pool while later lines are still being read;
+            # each entry only computes the levels its stored hash holds (capped by -K), stopping at the
+            # first mismatching level
+            entries, verify_entries = tee(
+                (expected_hash, entry_filepath, exists(entry_filepath))
+                for expected_hash, entry_filepath in load_hash_files(filepath, only=args.only)
+            )
+            verifications = verify_okhashes(
+                ((entry_filepath, expected_hash) for expected_hash, entry_filepath, entry_exists in verify_entries
+                 if entry_exists),
+                K=None if profile else args.K, workers=args.jobs, return_exceptions=True, cache=cache,
+                on_stats=on_stats, profile=profile
+            )
+
+            for expected_hash, entry_filepath, entry_exists in entries:
+                if not entry_exists:
                     print(f"okhash.py: {entry_filepath}: No such file or directory", file=sys.stderr)
                     if not args.ignore_missing:
                         _print_result(entry_filepath, 'FAILED open or read')
@@ -317,20 +2699,27 @@ def main():
                     status_code = 1
                     continue
 
-                try:
-                    calculated_hash = okhash_filepath(entry_filepath, K=args.K)
-
-                    if compare_okhashes(expected_hash, calculated_hash):
-                        _print_result(entry_filepath, 'OK')
-                    else:
-                        _print_result(entry_filepath, 'FAILED')
-                        checksum_errors += 1
-                        status_code = 1
-                except PermissionError as e:
+                verification = next(verifications)
+                if isinstance(verification, PermissionError):
                     print(f"okhash.py: {entry_filepath}: Permission denied", file=sys.stderr)
                     _print_result(entry_filepath, 'FAILED open or read')
                     file_errors += 1
                     status_code = 1
+                elif isinstance(verification, ProfileMismatchError):
+                    # the stored checksum does not carry the --profile it is checked with
+                    print(f"okhash.py: {entry_filepath}: checksum computed with a different hash profile",
+                          file=sys.stderr)
+                    _print_result(entry_filepath, 'FAILED')
+                    checksum_errors += 1
+                    status_code = 1
+                elif isinstance(verification, Exception):
+                    raise verification
+                elif verification:
+                    _print_result(entry_filepath, 'OK')
+                else:
+                    _print_result(entry_filepath, 'FAILED')
+                    checksum_errors += 1
+                    status_code = 1
 
                 # test_files/file2_1024.bin: FAILED open or read
 
@@ -349,16 +2738,41 @@ def main():
 
         else:
             if filepath == '-':
-                digest = okhash(_read_stdin(), K=args.K)
+                stdin_stats = HashStats() if on_stats else None
+                digest = okhash_stream(sys.stdin.buffer, K=args.K, stats=stdin_stats, profile=profile)
+                if on_stats:
+                    on_stats(filepath, stdin_stats)
             else:
-                try:
-                    digest = okhash_filepath(filepath, K=args.K)
-                except PermissionError as e:
+                digest = next(digests)
+                if isinstance(digest, PermissionError):
                     print(f"okhash.py: {filepath}: Permission denied", file=sys.stderr)
+                    file_errors += 1
                     status_code = 1
                     continue
-
-            print(f"{digest.hex()}  {filepath}", end='\x00' if args.zero else '\n')
+                elif isinstance(digest, Exception):
+                    raise digest
+
+            write(f"{digest.hex()}  {filepath}{end_of_line}")
+            if manifest_entries is not None:
+                manifest_entries.append((digest, filepath))
+
+    _fold_errors()
+    format_errors, file_errors, checksum_errors = 0, 0, 0
+    if progress is not None:
+        progress.stop()
+
+    if manifest_entries is not None:
+        write_binary_manifest(args.binary_manifest, manifest_entries)
+
+    if args.stats:
+        print(json.dumps(stats_summary), file=sys.stderr)
+
+    if cache is not None:
+        if args.cache_stats:
+            stats = cache.stats()
+            print(f"okhash.py: cache: {stats['hits']} hits, {stats['misses']} misses, {stats['stores']} stores, "
+                  f"{stats['evictions']} evictions, {stats['entries']} entries", file=sys.stderr)
+        cache.close()
 
     sys.exit(status_code)
 
@@ -5,12 +5,41 @@ import hashlib
 import random
 import math
 import okhash
+import asyncio
+import errno
+import http.server
+import io
+import json
+import os
 import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 
 TEST_MODIFICATION_TYPES = ['appended', 'truncated']
 TEST_SIZES = [1024, 1024 * 1024, 1024 * 1024 * 1024]
 TEST_DIR = 'test_files'
 BYTE_FLIP_TESTS = 100
+# cumulative `python -X importtime` of `import okhash`, with its bytecode cached
+IMPORT_TIME_BUDGET_US = 50000
+
+# sha256(okhash(data, K)).hexdigest()[:32] for K=1..4, where data = random.Random(size).randbytes(size)
+GOLDEN_VECTORS = {
+    0: ['5df6e0e2761359d30a8275058e299fcc', '5df6e0e2761359d30a8275058e299fcc',
+        '5df6e0e2761359d30a8275058e299fcc', '5df6e0e2761359d30a8275058e299fcc'],
+    1000: ['482f20642842e51cff48b7c7caa3dc68', '482f20642842e51cff48b7c7caa3dc68',
+           '482f20642842e51cff48b7c7caa3dc68', '482f20642842e51cff48b7c7caa3dc68'],
+    1500: ['688dccae477ccdc432f87207e9829788', '298c38e44c37bd02feefece4624f7e85',
+           '298c38e44c37bd02feefece4624f7e85', '298c38e44c37bd02feefece4624f7e85'],
+    3000: ['5b35af908bd09939b2f80a85be92db3a', 'c81c062e04265146cbe4ab7de1ed2d56',
+           'c81c062e04265146cbe4ab7de1ed2d56', 'c81c062e04265146cbe4ab7de1ed2d56'],
+    1536 * 1024: ['7e36742503f280598eed7ed26eab30c6', '68fc7b4444f8069518fb0d90184a323c',
+                  'e4d7010380f71d7cb1c92a4eb1f7aa61', 'e4d7010380f71d7cb1c92a4eb1f7aa61'],
+    3 * 1024 * 1024 + 17: ['2f03a8f56d87c3be3f4e97ef1a0f2af1', 'bd1e0a54808246a439fa21bd30b84a2d',
+                           'd784daa9b2bc053436ed1512686218b6', 'd784daa9b2bc053436ed1512686218b6'],
+}
 
 hashes = dict()
 
@@ -94,6 +123,80 @@ def _generate_random_file(filename, size, block_size=None):
     return filepath
 
 
+def _write_and_close(fd, data):
+    with open(fd, 'wb') as fou:
+        fou.write(data)
+
+
+# (input size, sha256 seed, expected position) for the block position chain, the last one needs digest extension
+GOLDEN_POSITIONS = [
+    (1, b'', 0),
+    (2049, b'2049', 1959),
+    (2 ** 20 * 3 + 17, b'abc', 2783203),
+    (2 ** 40 - 1, b'okhash', 802670826226),
+    (2 ** 300 + 7, b'extended',
+     1711353208415440650168002454834753563543464281121716508901421347431926050070666948359887294),
+]
+
+
+class _AsyncBytesReader:
+    # async range reader stand-in, yielding to the event loop on every read like a remote source would
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+
+    async def read_at(self, offset, n):
+        await asyncio.sleep(0)
+        self.reads += 1
+        return self.data[offset:offset + n]
+
+
+class _RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    # serves server.objects by path, answering Range requests unless the path starts with /norange, with a
+    # weak ETag (and a Last-Modified date) under /weak. If-Match is compared strongly, like real servers do.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):  # noqa
+        self.server.requests += 1
+        data = self.server.objects.get(self.path.removeprefix('/norange').removeprefix('/weak'))
+        if data is None:
+            self.send_error(404)
+            return
+        if self.path.startswith('/weak'):
+            headers = {'ETag': 'W/"v1"', 'Last-Modified': 'Thu, 01 Jan 2026 00:00:00 GMT'}
+        else:
+            headers = {'ETag': '"v1"'}
+        if self.headers.get('If-Match', headers['ETag']) != headers['ETag'] or \
+                self.headers.get('If-Match', '').startswith('W/'):
+            self.send_error(412)
+            return
+        status = 200
+        if 'Range' in self.headers and not self.path.startswith('/norange'):
+            start, end = map(int, self.headers['Range'].removeprefix('bytes=').split('-'))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status, headers['Content-Range'] = 206, f'bytes {start}-{min(end, len(data) - 1)}/{len(data)}'
+            data = data[start:end + 1]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestOkhash(unittest.TestCase):
     def setUp(self):
         if not exists(TEST_DIR):
@@ -197,5 +300,707 @@ class TestOkhash(unittest.TestCase):
                 self.assertTrue(success)
 
 
+class TestOkhashApi(unittest.TestCase):
+    # Fast tests over small temporary files, independent of the large fixtures above
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepaths = list()
+        for ix, size in enumerate([0, 1, 1024, 4096, 3 * 1024 * 1024]):
+            filepath = join(self.tmp_dir, f'file_{ix}.bin')
+            with open(filepath, 'wb') as fou:
+                fou.write(random.randbytes(size))
+            self.filepaths.append(filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_golden_vectors(self):
+        for size, expected in GOLDEN_VECTORS.items():
+            data = random.Random(size).randbytes(size)
+            for K in range(1, 5):
+                digest = okhash.okhash(data, K=K)
+                self.assertEqual(hashlib.sha256(digest).hexdigest()[:32], expected[K - 1], f"{size=} {K=}")
+
+    def test_read_backends(self):
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                data = fin.read()
+            for K in range(1, 4):
+                expected = okhash.okhash(data, K=K)
+                self.assertEqual(okhash.okhash(bytearray(data), K=K), expected)
+                self.assertEqual(okhash.okhash(memoryview(data), K=K), expected)
+                for backend in okhash.READ_BACKENDS:
+                    self.assertEqual(okhash.okhash_filepath(filepath, K=K, backend=backend), expected)
+
+        with self.assertRaises(ValueError):
+            okhash.okhash_filepath(self.filepaths[0], backend='unknown')
+
+    def test_fallback_sha256(self):
+        filepath = self.filepaths[-1]
+        with open(filepath, 'rb') as fin:
+            data = fin.read()
+            size = len(data)
+            for offset in (0, 1, 4096, size - 4097, size):
+                for chunk_size in (1, 4096, 3 * 4096 + 5, okhash.FALLBACK_CHUNK_SIZE):
+                    self.assertEqual(okhash._sha256_fd(fin.fileno(), offset, size, chunk_size),
+                                     hashlib.sha256(data[offset:]).digest())
+
+            fin.seek(10)
+            self.assertEqual(okhash.sha256(fin, chunk_size=4096), hashlib.sha256(data[10:]).digest())
+            self.assertEqual(fin.read(), b'')
+
+        # files hashed whole: auto picks the double-buffered reader, all backends agree
+        for K in (1, 2, 3):
+            digests = {okhash.okhash_filepath(filepath, K=K, backend=backend) for backend in okhash.READ_BACKENDS}
+            self.assertEqual(digests, {okhash.okhash(data, K=K)})
+
+    def test_import_time(self):
+        # the library import path stays free of CLI-only and optional machinery, within a startup budget
+        env = {key: value for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+        command = [sys.executable, '-X', 'importtime', '-c', 'import okhash']
+        cwd = os.path.dirname(os.path.abspath(okhash.__file__))
+        subprocess.run(command, cwd=cwd, env=env, capture_output=True, check=True)  # compile once
+        result = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+        cumulative = dict()
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1])
+
+        for module in ('asyncio', 'sqlite3', 'argparse', 'concurrent.futures', 'json', 'tempfile', 'typing'):
+            self.assertNotIn(module, cumulative)
+        self.assertLess(cumulative['okhash'], IMPORT_TIME_BUDGET_US)
+
+    def test_iter_file_list(self):
+        filepaths = [f'dir/file_{ix}.bin' for ix in range(100000)] + ['with\nnewline', 'with space ']
+        list_filepath = join(self.tmp_dir, 'list')
+        with open(list_filepath, 'wb') as fou:
+            fou.write(b'\x00'.join(os.fsencode(fp) for fp in filepaths) + b'\x00\x00')
+        self.assertEqual(list(okhash.iter_file_list(list_filepath, separator=b'\x00')), filepaths)
+
+        with open(list_filepath, 'wb') as fou:
+            fou.write(b'a\n\nb\nc')
+        self.assertEqual(list(okhash.iter_file_list(list_filepath)), ['a', 'b', 'c'])
+
+    def test_okhash_server(self):
+        socket_path = join(self.tmp_dir, 'okhash.sock')
+        server = okhash.okhash_server(socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            missing = join(self.tmp_dir, 'missing.bin')
+            for K in (1, 3):
+                expected = [okhash.okhash_filepath(fp, K=K) for fp in self.filepaths]
+                results = list(okhash.okhash_remote(socket_path, self.filepaths + [missing, self.tmp_dir], K=K,
+                                                    return_exceptions=True, batch_size=2))
+                self.assertEqual(results[:-2], expected)
+                self.assertIsInstance(results[-2], FileNotFoundError)
+                self.assertEqual(results[-2].filename, missing)
+                self.assertIsInstance(results[-1], IsADirectoryError)
+
+            # the K=1 digests are answered from the K=3 ones cached by the server
+            hits = server.cache.hits
+            self.assertEqual(list(okhash.okhash_remote(socket_path, self.filepaths, K=1)),
+                             [okhash.okhash_filepath(fp, K=1) for fp in self.filepaths])
+            self.assertEqual(server.cache.hits, hits + len(self.filepaths))
+
+            with self.assertRaises(FileNotFoundError):
+                list(okhash.okhash_remote(socket_path, [missing]))
+            with self.assertRaises(ValueError):
+                list(okhash.okhash_remote(socket_path, self.filepaths, K=0))
+
+            # paths must be strings, an integer would be opened as one of the daemon's own fds
+            for request in ({'paths': [3]}, {'paths': [None]}, {'paths': self.filepaths, 'K': 1000000}):
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(socket_path)
+                    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                    self.assertEqual(json.loads(sock.makefile('rb').readline()), {'error': 'Invalid request'})
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(exists(socket_path))
+
+    def test_progress_metrics(self):
+        counters = {'files': 3, 'bytes_read': 3 * 1024 * 1024, 'fallback': 1, 'cached': 0,
+                    'format_errors': 0, 'file_errors': 1, 'checksum_errors': 2}
+        stream, stderr = io.StringIO(), sys.stderr
+        metrics_filepath = join(self.tmp_dir, 'metrics.prom')
+        progress = okhash._ProgressReporter(lambda: counters, total_files=8, stream=stream,
+                                            metrics_path=metrics_filepath).start()
+        try:
+            self.assertIs(sys.stderr, progress)
+            progress._draw()
+            print("okhash.py: message", file=sys.stderr)
+        finally:
+            progress.stop()
+        self.assertIs(sys.stderr, stderr)
+
+        lines = stream.getvalue().split('\r\x1b[K')
+        self.assertIn("4/8 files, 3.0 MiB sampled", lines[1])
+        self.assertIn("ETA", lines[1])
+        self.assertEqual(lines[2], "okhash.py: message\n")
+        self.assertTrue(lines[-1].endswith(", 3 errors\n"))
+
+        with open(metrics_filepath) as fin:
+            metrics = dict(line.split() for line in fin if not line.startswith('#'))
+        self.assertEqual(metrics['okhash_files_total'], '3')
+        self.assertEqual(metrics['okhash_checksum_errors_total'], '2')
+        self.assertEqual(metrics['okhash_running'], '0')
+
+        okhash._write_metrics(metrics_filepath, {'files': 1, 'running': 1}, 'json')
+        with open(metrics_filepath) as fin:
+            self.assertEqual(json.load(fin), {'files': 1, 'running': 1})
+        self.assertEqual(os.listdir(self.tmp_dir).count('metrics.prom'), 1)
+
+    def test_hash_profile(self):
+        profile = okhash.HashProfile.parse('16k:1K, 1MiB:16K,64M:64K')
+        self.assertEqual(profile.spec, '16K:1K,1M:16K,64M:64K')
+        self.assertEqual(profile, okhash.HashProfile([(16384, 1024), (2 ** 20, 16384), (2 ** 26, 65536)]))
+        for spec in ('', '1K', '1K:2K', '1M:1K,1K:1K', 'x:1K'):
+            with self.assertRaises(ValueError):
+                okhash.HashProfile.parse(spec)
+
+        # the standard levels as a profile: same level digests, behind the profile header
+        standard = okhash.HashProfile([(2 ** 10, 1024), (2 ** 20, 4096), (2 ** 30, 256 * 1024)])
+        for filepath in self.filepaths:
+            digest = okhash.okhash_filepath(filepath, profile=standard)
+            self.assertEqual(digest[:okhash.SHA256_DIGEST_LEN], standard.header)
+            self.assertEqual(digest[okhash.SHA256_DIGEST_LEN:], okhash.okhash_filepath(filepath, K=3))
+
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                data = fin.read()
+            digest = okhash.okhash(data, profile=profile)
+            self.assertEqual(okhash.okhash(io.BytesIO(data), profile=profile, stats=okhash.HashStats()), digest)
+            self.assertEqual(okhash.okhash_filepath(filepath, profile=profile), digest)
+            self.assertTrue(okhash.compare_okhashes(digest, digest))
+            self.assertTrue(okhash.verify_okhash_filepath(filepath, digest, profile=profile))
+            self.assertTrue(okhash.verify_okhash_filepath(filepath, digest, profile=profile, early_exit=False))
+
+            # profiles are never mixed up with each other or with standard okhashes
+            with self.assertRaises(okhash.ProfileMismatchError):
+                okhash.compare_okhashes(digest, okhash.okhash(data, K=3))
+            with self.assertRaises(okhash.ProfileMismatchError):
+                okhash.verify_okhash_filepath(filepath, digest)
+            with self.assertRaises(okhash.ProfileMismatchError):
+                okhash.verify_okhash_filepath(filepath, digest, profile=standard)
+
+        self.assertEqual(list(okhash.verify_okhashes(
+            [(fp, okhash.okhash_filepath(fp, profile=profile)) for fp in self.filepaths], profile=profile)),
+            [True] * len(self.filepaths))
+        with self.assertRaises(ValueError):
+            okhash.okhash_filepath(self.filepaths[0], profile=profile, cache=okhash.OKHashCache(':memory:'))
+
+        # checked against a different profile: failed checksums, not improperly formatted lines
+        sums_path = join(self.tmp_dir, 'sums.txt')
+        with open(sums_path, 'w') as fou:
+            fou.writelines(f"{okhash.okhash_filepath(fp).hex()}  {fp}\n" for fp in self.filepaths)
+        result = subprocess.run([sys.executable, okhash.__file__, '--profile', '16K:1K', '-c', sums_path],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout.count(': FAILED'), len(self.filepaths))
+        self.assertNotIn('improperly formatted', result.stderr)
+        result = subprocess.run([sys.executable, okhash.__file__, '-K', '0', '-c', sums_path],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+
+    def test_profile_entry_points(self):
+        profile = okhash.HashProfile.parse('blake2b@16K:1K,1M:16K')
+        expected = [okhash.okhash_filepath(fp, profile=profile) for fp in self.filepaths]
+        buffers = list()
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                buffers.append(fin.read())
+
+        self.assertEqual(okhash.okhash_batch(buffers, profile=profile), expected)
+        self.assertEqual(list(okhash.okhash_scheduled(self.filepaths, profile=profile)), expected)
+        self.assertEqual([asyncio.run(okhash.okhash_async(_AsyncBytesReader(data), len(data), profile=profile))
+                          for data in buffers], expected)
+        for filepath, digest in zip(self.filepaths, expected):
+            with okhash.OKHasher(filepath, profile=profile) as hasher:
+                self.assertEqual(hasher.digest(), digest)
+
+    def test_digest_algorithm(self):
+        standard = okhash.HashProfile.standard(3)
+        self.assertEqual(standard, okhash.HashProfile([(2 ** 10, 1024), (2 ** 20, 4096), (2 ** 30, 256 * 1024)]))
+        profile = okhash.HashProfile.parse('BLAKE2b@16K:1K,1M:16K')
+        self.assertEqual(profile.spec, 'blake2b@16K:1K,1M:16K')
+        self.assertEqual(okhash.HashProfile.standard(2, 'blake2s').spec, 'blake2s@1K:1K,1M:4K')
+        with self.assertRaises(ValueError):
+            okhash.HashProfile.parse('md5@16K:1K')
+
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                data = fin.read()
+            digest = okhash.okhash(data, profile=profile)
+            self.assertEqual(digest[:okhash.SHA256_DIGEST_LEN], profile.header)
+            self.assertNotEqual(digest[okhash.SHA256_DIGEST_LEN:],
+                                okhash.okhash(data, profile=okhash.HashProfile.parse('16K:1K,1M:16K'))[
+                                    okhash.SHA256_DIGEST_LEN:])
+            self.assertEqual(okhash.okhash(io.BytesIO(data), profile=profile, stats=okhash.HashStats()), digest)
+            self.assertEqual(okhash.okhash_filepath(filepath, profile=profile), digest)
+            self.assertTrue(okhash.verify_okhash_filepath(filepath, digest, profile=profile))
+            with self.assertRaises(okhash.ProfileMismatchError):
+                okhash.verify_okhash_filepath(filepath, digest, profile=okhash.HashProfile.parse('16K:1K,1M:16K'))
+
+        # the first levels of a profile are checked against a shorter one, e.g. blake2b at K=3 and K=2
+        blake2b_2, blake2b_3 = okhash.HashProfile.standard(2, 'blake2b'), okhash.HashProfile.standard(3, 'blake2b')
+        self.assertNotEqual(blake2b_2.header, blake2b_3.header)
+        with self.assertRaises(ValueError):
+            okhash.HashProfile.standard(okhash.PROFILE_MAX_LEVELS + 1)
+        for filepath in self.filepaths:
+            digest_2 = okhash.okhash_filepath(filepath, profile=blake2b_2)
+            digest_3 = okhash.okhash_filepath(filepath, profile=blake2b_3)
+            self.assertTrue(okhash.compare_okhashes(digest_3, digest_2))
+            self.assertTrue(okhash.verify_okhash_filepath(filepath, digest_3, profile=blake2b_2))
+            self.assertTrue(okhash.verify_okhash_filepath(filepath, digest_2, profile=blake2b_3, early_exit=False))
+            with self.assertRaises(okhash.ProfileMismatchError):
+                okhash.compare_okhashes(digest_3, okhash.okhash_filepath(filepath, profile=profile))
+
+        sums_path = join(self.tmp_dir, 'sums.txt')
+        with open(sums_path, 'w') as fou:
+            fou.writelines(f"{okhash.okhash_filepath(fp, profile=blake2b_3).hex()}  {fp}\n" for fp in self.filepaths)
+        result = subprocess.run([sys.executable, okhash.__file__, '--algorithm', 'blake2b', '-c', sums_path],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertEqual(result.stdout.count(': OK'), len(self.filepaths))
+
+    def test_range_reader(self):
+        data = random.randbytes(100000)
+        fetched = list()
+
+        def _read_range(offset, length):
+            fetched.append((offset, length))
+            return data[offset:offset + length]
+
+        reader = okhash.RangeReader(_read_range, len(data), block_size=1000, cache_bytes=10000)
+        reader.seek(1500)
+        self.assertEqual(bytes(reader.read(5000)), data[1500:6500])
+        self.assertEqual(fetched, [(1000, 6000)])
+        # cached blocks are not fetched again, each run of missing blocks around them in its own request
+        reader.seek(500)
+        self.assertEqual(bytes(reader.read(7000)), data[500:7500])
+        self.assertEqual(fetched[1:], [(0, 1000), (7000, 1000)])
+        reader.seek(0)
+        self.assertEqual(bytes(reader.read(9500)), data[:9500])
+        self.assertEqual(fetched[3:], [(8000, 2000)])
+        reader.seek(99990)
+        self.assertEqual(bytes(reader.read(100)), data[99990:])
+        self.assertEqual(reader.read(100), b'')
+        self.assertEqual(reader.requests, 5)
+        self.assertLessEqual(len(reader.blocks), 10)
+
+        # larger than the cache
+        reader.seek(0)
+        self.assertEqual(bytes(reader.read()), data)
+
+    def test_okhash_url(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+        server.objects, server.requests, server.connections = dict(), 0, 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+        try:
+            for ix, filepath in enumerate(self.filepaths):
+                with open(filepath, 'rb') as fin:
+                    server.objects[f'/file_{ix}.bin'] = fin.read()
+                for K in range(1, 4):
+                    self.assertEqual(okhash.okhash_url(f'{base_url}/file_{ix}.bin', K=K),
+                                     okhash.okhash_filepath(filepath, K=K))
+
+            # a sampled 3 MiB object: the size probe, then at most one request per block of the two levels,
+            # the first block being shared
+            requests = server.requests
+            profile = okhash.HashProfile.parse('blake2b@16K:1K,1M:16K')
+            self.assertEqual(okhash.okhash_url(f'{base_url}/file_4.bin', K=2),
+                             okhash.okhash_filepath(self.filepaths[4], K=2))
+            self.assertLessEqual(server.requests - requests, 1 + 1 + 255)
+            self.assertEqual(okhash.okhash_url(f'{base_url}/file_4.bin', profile=profile),
+                             okhash.okhash_filepath(self.filepaths[4], profile=profile))
+            # all over kept-alive connections
+            self.assertEqual(server.connections, 1)
+
+            self.assertEqual(okhash.okhash_url(f'{base_url}/weak/file_4.bin'),
+                             okhash.okhash_filepath(self.filepaths[4]))
+
+            with self.assertRaises(OSError):
+                okhash.okhash_url(f'{base_url}/missing.bin')
+            with self.assertRaises(OSError):
+                okhash.okhash_url(f'{base_url}/norange/file_4.bin')
+            with self.assertRaises(ValueError):
+                okhash.okhash_url('ftp://127.0.0.1/file_4.bin')
+        finally:
+            okhash._http_pool.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_okhash_stream(self):
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                data = fin.read()
+            for K in range(1, 4):
+                expected = okhash.okhash(data, K=K)
+                with open(filepath, 'rb', buffering=0) as fin:
+                    self.assertEqual(okhash.okhash_stream(fin, K=K), expected)
+
+                read_fd, write_fd = os.pipe()
+                writer = threading.Thread(target=_write_and_close, args=(write_fd, data))
+                writer.start()
+                with open(read_fd, 'rb') as pipe:
+                    self.assertEqual(okhash.okhash_stream(pipe, K=K), expected)
+                writer.join()
+
+    def test_cache(self):
+        cache_path = join(self.tmp_dir, 'cache.sqlite')
+        with okhash.OKHashCache(cache_path) as cache:
+            for K in (3, 1, 2):
+                for filepath in self.filepaths:
+                    self.assertEqual(okhash.okhash_filepath(filepath, K=K, cache=cache),
+                                     okhash.okhash_filepath(filepath, K=K))
+            stats = cache.stats()
+            # K=3 digests answer the later K=1 and K=2 lookups
+            self.assertEqual((stats['misses'], stats['hits']), (len(self.filepaths), 2 * len(self.filepaths)))
+
+        # a modified file is a cache miss
+        with open(self.filepaths[2], 'ab') as fou:
+            fou.write(b'appended')
+        with okhash.OKHashCache(cache_path, max_entries=2) as cache:
+            self.assertEqual(okhash.okhash_filepath(self.filepaths[2], cache=cache),
+                             okhash.okhash_filepath(self.filepaths[2]))
+            self.assertEqual(cache.stats()['misses'], 1)
+            self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_verify_okhashes(self):
+        entries = list()
+        for K in range(1, 5):
+            for filepath in self.filepaths:
+                entries.append((filepath, okhash.okhash_filepath(filepath, K=K)))
+                entries.append((filepath, okhash.okhash_filepath(self.filepaths[0], K=K)))
+
+        expected = [okhash.compare_okhashes(expected_hash, okhash.okhash_filepath(filepath, K=4))
+                    for filepath, expected_hash in entries]
+        for early_exit in (True, False):
+            self.assertEqual(list(okhash.verify_okhashes(entries, early_exit=early_exit, workers=2)), expected)
+            self.assertEqual(list(okhash.verify_okhashes(entries, K=1, early_exit=early_exit)),
+                             [okhash.compare_okhashes(expected_hash, okhash.okhash_filepath(filepath, K=1))
+                              for filepath, expected_hash in entries])
+        self.assertFalse(okhash.verify_okhash_filepath(self.filepaths[0], b''))
+
+    def test_okhash_async(self):
+        async def _hash_all(buffers, K):
+            return await asyncio.gather(*(okhash.okhash_async(_AsyncBytesReader(data), len(data), K=K)
+                                          for data in buffers))
+
+        buffers = list()
+        for filepath in self.filepaths:
+            with open(filepath, 'rb') as fin:
+                buffers.append(fin.read())
+
+        for K in range(1, 5):
+            self.assertEqual(asyncio.run(_hash_all(buffers, K)), [okhash.okhash(data, K=K) for data in buffers])
+
+    def test_next_position(self):
+        for size, seed, expected in GOLDEN_POSITIONS:
+            self.assertEqual(okhash._calculate_next_position(hashlib.sha256(seed), size), expected)
+            self.assertEqual(okhash._next_position_func(size)(hashlib.sha256(seed)), expected)
+
+        rng = random.Random(0)
+        sizes = [2 ** e + d for e in range(0, 70) for d in (-1, 0, 1) if 2 ** e + d > 0]
+        sizes += [rng.randrange(1, 2 ** 64) for _ in range(200)] + [2 ** 256 - 1, 2 ** 256, 2 ** 257 + 3]
+        for size in sizes:
+            next_position = okhash._next_position_func(size)
+            m = hashlib.sha256(str(size).encode('utf-8'))
+            for _ in range(5):
+                position = next_position(m)
+                self.assertEqual(position, okhash._calculate_next_position(m, size), f"{size=}")
+                m.update(position.to_bytes(64, 'big'))
+
+    def test_hash_stats(self):
+        data = random.Random(0).randbytes(3 * 1024 * 1024)
+        stats = okhash.HashStats()
+        self.assertEqual(okhash.okhash(data, K=4, stats=stats), okhash.okhash(data, K=4))
+        # shared first block, sampled K=1 and K=2, one fallback computed at K=3 (K=4 downgrades to 3)
+        self.assertEqual([level['k'] for level in stats.levels], [0, 1, 2, 3])
+        self.assertEqual([level['fallback'] for level in stats.levels], [False, False, False, True])
+        self.assertEqual(stats.levels[1]['blocks'], 1)
+        self.assertEqual(stats.levels[2]['blocks'], 256)
+        self.assertEqual(stats.levels[3]['bytes_read'], len(data))
+        self.assertTrue(stats.fallback)
+        self.assertGreater(stats.bytes_read, len(data))
+
+        collected = dict()
+        digests = list(okhash.okhash_many(self.filepaths, K=2, workers=2,
+                                          on_stats=lambda fp, st: collected.update({fp: st.as_dict()})))
+        self.assertEqual(digests, [okhash.okhash_filepath(fp, K=2) for fp in self.filepaths])
+        self.assertEqual(set(collected), set(self.filepaths))
+        self.assertEqual(collected[self.filepaths[0]]['bytes_read'], 0)
+
+    def test_find_duplicates(self):
+        search_dir = join(self.tmp_dir, 'search')
+        makedirs(join(search_dir, 'sub'))
+        small, large = random.randbytes(1500), random.randbytes(3 * 1024 * 1024)
+        # same size as `large`, only differs outside of the K=1 sample
+        large_variant = bytearray(large)
+        large_variant[okhash._next_position_func(len(large))(hashlib.sha256(str(len(large)).encode())) + 2048] ^= 1
+        contents = {
+            'a.bin': small, 'sub/a_copy.bin': small, 'b.bin': random.randbytes(1500),
+            'large.bin': large, 'sub/large_copy.bin': large, 'large_variant.bin': bytes(large_variant),
+            'unique.bin': random.randbytes(10),
+        }
+        for name, data in contents.items():
+            with open(join(search_dir, name), 'wb') as fou:
+                fou.write(data)
+
+        expected = sorted([
+            sorted([join(search_dir, 'a.bin'), join(search_dir, 'sub/a_copy.bin')]),
+            sorted([join(search_dir, 'large.bin'), join(search_dir, 'sub/large_copy.bin')]),
+        ])
+        for full_hash in (False, True):
+            groups = okhash.find_duplicates([search_dir], K=2, full_hash=full_hash, workers=2)
+            self.assertEqual(sorted(sorted(group) for group in groups), expected)
+
+        # K=1 cannot tell the variant apart, full_hash does
+        groups = sorted(sorted(group) for group in okhash.find_duplicates([search_dir], K=1))
+        self.assertIn(join(search_dir, 'large_variant.bin'), groups[1])
+        groups = sorted(sorted(group) for group in okhash.find_duplicates([search_dir], K=1, full_hash=True))
+        self.assertEqual(groups, expected)
+
+        # files that cannot be hashed are reported to onerror, not silently dropped
+        unreadable = join(search_dir, 'sub/a_copy.bin')
+        level_digest_filepath = okhash._level_digest_filepath
+
+        def _level_digest_filepath(task):
+            if task[0] == unreadable:
+                raise PermissionError(13, 'Permission denied', unreadable)
+            return level_digest_filepath(task)
+
+        errors = list()
+        okhash._level_digest_filepath = _level_digest_filepath
+        try:
+            groups = sorted(sorted(group) for group in okhash.find_duplicates([search_dir], K=2, onerror=errors.append))
+        finally:
+            okhash._level_digest_filepath = level_digest_filepath
+        self.assertEqual(groups, expected[1:])
+        self.assertEqual([e.filename for e in errors], [unreadable])
+
+    def test_okhash_batch(self):
+        rng = random.Random(1)
+        buffers = [rng.randbytes(size) for size in (0, 1, 1024, 1500, 3000, 2 * 1024 * 1024, 3 * 1024 * 1024 + 17)]
+        buffers += [bytearray(buffers[-1]), memoryview(buffers[-2]), 'Hello World!']
+        for K in range(1, 5):
+            expected = [b''.join(okhash._okhash_levels(buffer, None, K)) for buffer in buffers]
+            self.assertEqual(okhash.okhash_batch(buffers, K=K), expected)
+            self.assertEqual(okhash.okhash_batch(buffers, K=K, workers=1), expected)
+            self.assertEqual([okhash.okhash(buffer, K=K) for buffer in buffers], expected)
+
+    def test_walk_files(self):
+        walk_dir = join(self.tmp_dir, 'walk')
+        makedirs(join(walk_dir, 'b', 'c'))
+        for name in ('a.bin', 'b/x.bin', 'b/c/y.bin', 'd.bin'):
+            with open(join(walk_dir, name), 'wb') as fou:
+                fou.write(name.encode())
+        os.symlink(join(walk_dir, 'b'), join(walk_dir, 'link'))
+        os.symlink(walk_dir, join(walk_dir, 'b', 'loop'))
+
+        walked = [(fp, st.st_size) for fp, st in okhash.walk_files([walk_dir])]
+        self.assertEqual(walked, [(join(walk_dir, name), len(name))
+                                  for name in ('a.bin', 'b/c/y.bin', 'b/x.bin', 'd.bin')])
+
+        # symlinked directories are followed once, cycles are cut
+        walked = [fp for fp, st in okhash.walk_files([walk_dir], follow_symlinks=True)]
+        self.assertEqual(len(walked), 4)
+        self.assertEqual(len(set(os.path.realpath(fp) for fp in walked)), 4)
+
+        errors = list()
+        self.assertEqual(list(okhash.walk_files([join(walk_dir, 'missing')], onerror=errors.append)), [])
+        self.assertIsInstance(errors[0], FileNotFoundError)
+
+    def test_okhash_tree(self):
+        source, replica = join(self.tmp_dir, 'source'), join(self.tmp_dir, 'replica')
+        makedirs(join(source, 'b', 'c'))
+        makedirs(join(source, 'e'))
+        for name in ('a.bin', 'b/x.bin', 'b/c/y.bin', 'b/c/z.bin', 'd.bin', 'e/w.bin'):
+            with open(join(source, name), 'wb') as fou:
+                fou.write(name.encode() * 1000)
+        shutil.copytree(source, replica)
+
+        cache = okhash.OKHashCache(':memory:')
+        nodes = list(okhash.okhash_tree(source, K=2, cache=cache))
+        self.assertEqual([node for node, _ in nodes],
+                         ['./a.bin', './b/c/y.bin', './b/c/z.bin', './b/c/', './b/x.bin', './b/', './d.bin',
+                          './e/w.bin', './e/', './'])
+        self.assertEqual(dict(nodes)['./d.bin'], okhash.okhash_filepath(join(source, 'd.bin'), K=2))
+
+        tree_filepath = join(self.tmp_dir, 'source.tree')
+        self.assertEqual(okhash.write_tree_file(tree_filepath, nodes), nodes[-1][1])
+        source_tree = okhash.load_tree_file(tree_filepath)
+        self.assertEqual(source_tree, dict(nodes))
+
+        replica_tree = dict(okhash.okhash_tree(replica, K=2))
+        self.assertEqual(replica_tree, source_tree)
+        self.assertEqual(list(okhash.diff_okhash_trees(source_tree, replica_tree)), [])
+
+        with open(join(replica, 'b', 'c', 'y.bin'), 'ab') as fou:
+            fou.write(b'changed')
+        os.unlink(join(replica, 'a.bin'))
+        shutil.rmtree(join(replica, 'e'))
+        makedirs(join(replica, 'f'))
+        with open(join(replica, 'f', 'new.bin'), 'wb') as fou:
+            fou.write(b'new')
+        replica_tree = dict(okhash.okhash_tree(replica, K=2))
+        self.assertEqual(replica_tree['./b/x.bin'], source_tree['./b/x.bin'])
+        self.assertNotEqual(replica_tree['./b/'], source_tree['./b/'])
+        self.assertEqual(list(okhash.diff_okhash_trees(source_tree, replica_tree)),
+                         [('./a.bin', 'missing'), ('./b/c/y.bin', 'changed'), ('./e/', 'missing'), ('./f/', 'new')])
+
+        # rebuilding with the cache only hashes the files that changed
+        with open(join(source, 'd.bin'), 'ab') as fou:
+            fou.write(b'changed')
+        misses = cache.misses
+        dict(okhash.okhash_tree(source, K=2, cache=cache))
+        self.assertEqual(cache.misses, misses + 1)
+
+        with self.assertRaises(NotADirectoryError):
+            list(okhash.okhash_tree(join(source, 'd.bin')))
+
+    def test_manifests(self):
+        entries = [(okhash.okhash_filepath(fp, K=K), fp) for K in (1, 3) for fp in self.filepaths]
+        text_path, binary_path = join(self.tmp_dir, 'manifest.txt'), join(self.tmp_dir, 'manifest.okhm')
+        with open(text_path, 'w') as fou:
+            for digest, filepath in entries:
+                fou.write(f"{digest.hex()}  {filepath}\n")
+            fou.write("not-a-hash  file\n\n")
+        okhash.write_binary_manifest(binary_path, entries)
+
+        format_errors = list()
+        self.assertEqual(list(okhash.iter_hash_file(text_path, format_errors.append)), entries)
+        self.assertEqual(format_errors, [len(entries) + 1])
+        self.assertEqual(sorted(okhash.iter_hash_file(binary_path), key=lambda e: (e[1], len(e[0]))),
+                         sorted(entries, key=lambda e: (e[1], len(e[0]))))
+
+        with okhash.BinaryManifest(binary_path) as manifest:
+            self.assertEqual(len(manifest), len(entries))
+            for digest, filepath in entries:
+                self.assertIn(digest, manifest.lookup(filepath))
+            self.assertEqual(manifest.lookup(join(self.tmp_dir, 'missing.bin')), [])
+
+        only = [self.filepaths[1], join(self.tmp_dir, 'missing.bin')]
+        for manifest_path in (text_path, binary_path):
+            self.assertEqual(sorted(len(digest) for digest, fp in okhash.iter_hash_file(manifest_path, only=only)),
+                             [okhash.SHA256_DIGEST_LEN, okhash.SHA256_DIGEST_LEN])
+        with self.assertRaises(ValueError):
+            okhash.BinaryManifest(text_path)
+
+        # a text manifest read from a pipe, which can only be read once
+        fifo_path = join(self.tmp_dir, 'manifest.fifo')
+        os.mkfifo(fifo_path)
+        with open(text_path, 'rb') as fin:
+            data = fin.read()
+        writer = threading.Thread(target=lambda: _write_and_close(os.open(fifo_path, os.O_WRONLY), data))
+        writer.start()
+        self.assertEqual(list(okhash.iter_hash_file(fifo_path)), entries)
+        writer.join()
+
+    def test_okhasher(self):
+        filepath = join(self.tmp_dir, 'growing.bin')
+        open(filepath, 'wb').close()
+        with okhash.OKHasher(filepath, K=3) as hasher:
+            for chunk_size in (0, 100, 1000, 3000, 1024 * 1024, 2 * 1024 * 1024, 10):
+                with open(filepath, 'ab') as fou:
+                    fou.write(random.randbytes(chunk_size))
+                bytes_read = hasher.bytes_read
+                self.assertEqual(hasher.update_size(), chunk_size > 0)
+                self.assertEqual(hasher.digest(), okhash.okhash_filepath(filepath, K=3))
+                self.assertEqual(hasher.digest(), okhash.okhash_filepath(filepath, K=3))
+                if chunk_size and hasher.size <= 2048:
+                    # full SHA-256 fallback: only the appended bytes are read
+                    self.assertEqual(hasher.bytes_read - bytes_read, chunk_size)
+
+            # unchanged size: no I/O at all
+            bytes_read = hasher.bytes_read
+            self.assertFalse(hasher.update_size())
+            hasher.digest()
+            self.assertEqual(hasher.bytes_read, bytes_read)
+
+            with open(filepath, 'r+b') as fou:
+                fou.truncate(5000)
+            self.assertTrue(hasher.update_size())
+            self.assertEqual(hasher.digest(), okhash.okhash_filepath(filepath, K=3))
+
+        # any seekable stream, without a file descriptor
+        stream = io.BytesIO()
+        with okhash.OKHasher(stream, K=3) as hasher:
+            for chunk_size in (0, 1000, 3000, 3 * 1024 * 1024):
+                stream.seek(0, 2)
+                stream.write(random.randbytes(chunk_size))
+                self.assertEqual(hasher.update_size(), chunk_size > 0)
+                self.assertEqual(hasher.digest(), okhash.okhash(stream.getvalue(), K=3))
+        self.assertFalse(stream.closed)
+
+    def test_sparse_backend(self):
+        filepath = join(self.tmp_dir, 'sparse.bin')
+        rng = random.Random(2)
+        with open(filepath, 'wb') as fou:
+            fou.truncate(64 * 1024 * 1024 + 123)
+            for offset in (0, 5 * 1024 * 1024 + 77, 40 * 1024 * 1024, 64 * 1024 * 1024 - 1000):
+                fou.seek(offset)
+                fou.write(rng.randbytes(300 * 1024))
+            fou.truncate(64 * 1024 * 1024 + 123)
+
+        for K in range(1, 4):
+            expected = okhash.okhash_filepath(filepath, K=K, backend='buffered')
+            for backend in ('sparse', 'auto'):
+                self.assertEqual(okhash.okhash_filepath(filepath, K=K, backend=backend), expected)
+
+        # file systems without SEEK_DATA/SEEK_HOLE support: read as plain data, not as holes
+        lseek = os.lseek
+
+        def _lseek(fd, position, whence):
+            if whence in (os.SEEK_DATA, os.SEEK_HOLE):
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return lseek(fd, position, whence)
+
+        os.lseek = _lseek
+        try:
+            self.assertEqual(okhash.okhash_filepath(filepath, K=3, backend='sparse'),
+                             okhash.okhash_filepath(filepath, K=3, backend='buffered'))
+        finally:
+            os.lseek = lseek
+
+        for filepath in self.filepaths:
+            self.assertEqual(okhash.okhash_filepath(filepath, K=3, backend='sparse'),
+                             okhash.okhash_filepath(filepath, K=3))
+
+    def test_okhash_scheduled(self):
+        missing = join(self.tmp_dir, 'missing.bin')
+        filepaths = self.filepaths + [missing] + self.filepaths[::-1]
+        for K in range(1, 4):
+            expected = [okhash.okhash_filepath(fp, K=K) for fp in self.filepaths]
+            for batch_size in (1, 3, 64):
+                results = list(okhash.okhash_scheduled(filepaths, K=K, batch_size=batch_size, return_exceptions=True))
+                self.assertEqual(results[:len(expected)], expected)
+                self.assertIsInstance(results[len(expected)], FileNotFoundError)
+                self.assertEqual(results[len(expected) + 1:], expected[::-1])
+
+        with self.assertRaises(FileNotFoundError):
+            list(okhash.okhash_scheduled([missing] + self.filepaths))
+
+    def test_okhash_many(self):
+        for K in range(1, 4):
+            expected = [okhash.okhash_filepath(fp, K=K) for fp in self.filepaths]
+            for workers in (1, 4):
+                self.assertEqual(list(okhash.okhash_many(self.filepaths, K=K, workers=workers)), expected)
+
+        missing = join(self.tmp_dir, 'missing.bin')
+        results = list(okhash.okhash_many([missing] + self.filepaths, workers=2, return_exceptions=True))
+        self.assertIsInstance(results[0], FileNotFoundError)
+        self.assertEqual(results[1:], [okhash.okhash_filepath(fp) for fp in self.filepaths])
+        with self.assertRaises(FileNotFoundError):
+            list(okhash.okhash_many([missing], workers=2))
+
+
 if __name__ == '__main__':
     unittest.main()